@@ -1,49 +1,113 @@
 import os
+import time
+import random
 import traceback
 import json
 import asyncio
 import aiohttp
 import websockets
 
+import bulk
+from bot import Bot, Runtime
+from decode import is_ping, loads, message_entities
+from pipeline import EntityQueue, run_pipeline
+from metrics import metrics
+from ratelimit import limiter
+from world import World
+
 RC_APP_ID = os.environ["RC_APP_ID"]
 RC_APP_SECRET = os.environ["RC_APP_SECRET"]
 RC_APP_ENDPOINT = os.environ.get("RC_ENDPOINT", "recurse.rctogether.com")
+# Set RC_SSL=0 to talk plain http/ws, e.g. to the local stand-in in fakeserver.py.
+RC_APP_SSL = os.environ.get("RC_SSL", "1") != "0"
+
+# Bounds, in seconds, for the backoff between websocket reconnection attempts.
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
 
 
 class HttpError(Exception):
-    pass
+    def __init__(self, status, body, retry_after=None):
+        super().__init__(status, body)
+        self.retry_after = retry_after
 
 
 def api_url(resource, resource_id=None):
     if resource_id is not None:
         resource = f"{resource}/{resource_id}"
 
-    return f"https://{RC_APP_ENDPOINT}/api/{resource}?app_id={RC_APP_ID}&app_secret={RC_APP_SECRET}"
+    return f"{'https' if RC_APP_SSL else 'http'}://{RC_APP_ENDPOINT}/api/{resource}?app_id={RC_APP_ID}&app_secret={RC_APP_SECRET}"
 
 
 async def parse_response(response):
     if response.status != 200:
         body = await response.text()
-        raise HttpError(response.status, body)
+        raise HttpError(response.status, body, response.headers.get("Retry-After"))
     return await response.json()
 
 
-async def get_bots():
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url=api_url("bots")) as response:
-            return await parse_response(response)
+# Connection pool settings for the shared client. Every bot PATCH reuses one of
+# these keep-alive connections rather than paying for a fresh TCP+TLS handshake.
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 20
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+
+
+class Client:
+    def __init__(
+        self,
+        limit=CONNECTION_LIMIT,
+        limit_per_host=CONNECTION_LIMIT_PER_HOST,
+        dns_cache_ttl=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
 
-
-async def delete_bot(bot_id):
-    async with aiohttp.ClientSession() as session:
-        async with session.delete(url=api_url("bots", bot_id)) as response:
+    @property
+    def session(self):
+        # Created lazily so that the session is bound to the running event loop.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def request(self, method, resource, resource_id=None, json=None):
+        async with self.session.request(
+            method, api_url(resource, resource_id), json=json
+        ) as response:
             return await parse_response(response)
 
+    async def get_bots(self):
+        return await self.request("GET", "bots")
 
-async def create_bot(name, emoji, x=5, y=2, direction="right", can_be_mentioned=False):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            api_url("bots"),
+    async def delete_bot(self, bot_id):
+        return await self.request("DELETE", "bots", bot_id)
+
+    async def create_bot(self, name, emoji, x=5, y=2, direction="right", can_be_mentioned=False):
+        return await self.request(
+            "POST",
+            "bots",
             json={
                 "bot": {
                     "name": name,
@@ -54,27 +118,61 @@ async def create_bot(name, emoji, x=5, y=2, direction="right", can_be_mentioned=
                     "can_be_mentioned": can_be_mentioned,
                 }
             },
-        ) as response:
-            return await parse_response(response)
+        )
+
+    async def update_bot(self, bot_id, bot_attributes):
+        return await self.request("PATCH", "bots", bot_id, json={"bot": bot_attributes})
+
+    async def send_message(self, bot_id, message_text):
+        return await self.request("POST", "messages", json={"bot_id": bot_id, "text": message_text})
+
+
+# Shared by the module level helpers below, and by any RcTogether or Bot that
+# isn't given a client of its own. The helpers share the process-wide rate
+# limiter with the bots' runtime.
+default_client = Client()
+
+
+async def get_bots():
+    return await limiter.request(default_client.get_bots, endpoint="GET /api/bots")
+
+
+async def delete_bot(bot_id):
+    return await limiter.request(
+        lambda: default_client.delete_bot(bot_id), endpoint="DELETE /api/bots/{bot_id}"
+    )
+
+
+async def create_bot(name, emoji, x=5, y=2, direction="right", can_be_mentioned=False):
+    return await limiter.request(
+        lambda: default_client.create_bot(
+            name=name,
+            emoji=emoji,
+            x=x,
+            y=y,
+            direction=direction,
+            can_be_mentioned=can_be_mentioned,
+        ),
+        endpoint="POST /api/bots",
+    )
 
 
 async def update_bot(bot_id, bot_attributes):
-    async with aiohttp.ClientSession() as session:
-        async with session.patch(api_url("bots", bot_id), json={"bot": bot_attributes}) as response:
-            return await parse_response(response)
+    return await limiter.request(
+        lambda: default_client.update_bot(bot_id, bot_attributes),
+        endpoint="PATCH /api/bots/{bot_id}",
+    )
 
 
 async def send_message(bot_id, message_text):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            url=api_url("messages"), json={"bot_id": bot_id, "text": message_text}
-        ) as response:
-            return await parse_response(response)
+    return await limiter.request(
+        lambda: default_client.send_message(bot_id, message_text),
+        endpoint="POST /api/messages",
+    )
 
 
-async def clean_up_bots():
-    bots = await get_bots()
-    asyncio.gather(*[delete_bot(bot["id"]) for bot in bots])
+async def clean_up_bots(client=default_client):
+    return await bulk.delete_all(client)
 
 
 def with_tracebacks(f):
@@ -88,75 +186,79 @@ def with_tracebacks(f):
     return wrapper
 
 
-class Bot:
-    def __init__(self, bot_json, handle_update=None):
-        self.bot_json = bot_json
-        self.queue = asyncio.Queue()
-        self.handle_update = handle_update
+async def timed(handler, entity, label):
+    start = time.perf_counter()
+    try:
+        await handler(entity)
+    finally:
+        metrics.observe("handler", time.perf_counter() - start, handler=label)
 
-    @classmethod
-    async def create(cls, name, emoji, x, y, handle_update=None, can_be_mentioned=False):
-        bot_json = await create_bot(
-            name=name, emoji=emoji, x=x, y=y, can_be_mentioned=can_be_mentioned
-        )
-        bot = cls(bot_json, handle_update)
-        asyncio.create_task(bot.run())
-        return bot
 
-    @property
-    def id(self):
-        return self.bot_json["id"]
+class Subscription:
+    """The ApiChannel websocket subscription, as an async iterator of entities.
 
-    @property
-    def emoji(self):
-        return self.bot_json["emoji"]
+    Reconnects with jittered exponential backoff whenever the connection
+    drops. The world snapshot sent after resubscribing is compared against the
+    entities we already know about, and only entities that changed while we
+    were disconnected are yielded.
 
-    @property
-    def name(self):
-        return self.bot_json["name"]
+    An app that only cares about some entities can pass wants, which is given
+    each raw entity dict and says whether to decode it at all."""
+
+    def __init__(self, recorder=None, wants=None):
+        self.recorder = recorder
+        self.wants = wants
+        self.known = {}
 
-    async def run(self):
+    async def __aiter__(self):
+        delay = RECONNECT_MIN_DELAY
         while True:
-            update = await self.queue.get()
-            while not self.queue.empty():
-                print("Skipping outdated update: ", update)
-                update = await self.queue.get()
-            print("Applying update: ", update)
             try:
-                await update_bot(self.id, update)
-            except HttpError as exc:
-                print(f"Update failed: {self!r}, {exc!r}")
-            await asyncio.sleep(1)
-
-    async def update(self, update):
-        await self.queue.put(update)
-
-    def update_data(self, data):
-        self.bot_json = data
-
-    async def handle_entity(self, entity):
-        print("Bot update!")
-        self.bot_json = entity
-        if self.handle_update:
-            await self.handle_update(entity)
-
-    def __repr__(self):
-        return "<Bot name=%r>" % (self.name,)
-
-
-class RcTogether:
-    def __init__(self, callbacks=()):
-        self.callbacks = callbacks
-        self.bots = {}
-
-    async def run_websocket(self):
-        origin = f"https://{RC_APP_ENDPOINT}"
-        url = f"wss://{RC_APP_ENDPOINT}/cable?app_id={RC_APP_ID}&app_secret={RC_APP_SECRET}"
-
-        async with websockets.connect(url, ssl=True, origin=origin) as connection:
+                async for message in self.messages():
+                    delay = RECONNECT_MIN_DELAY
+                    start = time.perf_counter()
+                    entities = self.changed_entities(message)
+                    metrics.observe("decode", time.perf_counter() - start)
+                    for entity in entities:
+                        yield entity
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as exc:
+                print(f"Websocket connection lost: {exc!r}")
+            else:
+                print("Websocket closed by server.")
+
+            wait = random.uniform(0, delay)
+            print(f"Reconnecting in {wait:.1f}s")
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def changed_entities(self, message):
+        entities = message_entities(message, self.wants)
+        if message["type"] != "world":
+            for entity in entities:
+                self.known[entity.id] = entity
+            return entities
+
+        changed = [entity for entity in entities if self.known.get(entity.id) != entity]
+        self.known = {entity.id: entity for entity in entities}
+        return changed
+
+    async def messages(self):
+        scheme = "s" if RC_APP_SSL else ""
+        origin = f"http{scheme}://{RC_APP_ENDPOINT}"
+        url = f"ws{scheme}://{RC_APP_ENDPOINT}/cable?app_id={RC_APP_ID}&app_secret={RC_APP_SECRET}"
+
+        async with websockets.connect(
+            url, ssl=True if RC_APP_SSL else None, origin=origin
+        ) as connection:
             subscription_identifier = json.dumps({"channel": "ApiChannel"})
             async for msg in connection:
-                data = json.loads(msg)
+                if self.recorder:
+                    self.recorder.record(msg)
+                if is_ping(msg):
+                    continue
+                start = time.perf_counter()
+                data = loads(msg)
+                metrics.observe("parse", time.perf_counter() - start)
 
                 message_type = data.get("type")
 
@@ -175,30 +277,72 @@ class RcTogether:
                     and data["identifier"] == subscription_identifier
                     and "message" in data
                 ):
-                    await self.handle_message(data["message"])
+                    yield data["message"]
                 else:
                     print("Unknown message type: ", message_type)
 
-    async def create_bot(self, name, emoji, x, y, handle_update, can_be_mentioned=False):
-        bot = await Bot.create(name, emoji, x, y, handle_update, can_be_mentioned)
-        self.bots[bot.id] = bot
-        return bot
+
+class RcTogether:
+    def __init__(
+        self,
+        callbacks=(),
+        client=default_client,
+        recorder=None,
+        runtime=None,
+        world=None,
+        name="rctogether",
+        wants=None,
+    ):
+        self.callbacks = callbacks
+        # Labels this app's timings.
+        self.name = name
+        self.client = client
+        self.runtime = runtime if runtime is not None else Runtime(client)
+        self.subscription = Subscription(recorder, wants)
+        self.events = None
+        # When hosted alongside other apps, the host keeps the shared world up
+        # to date.
+        self.owns_world = world is None
+        self.world = World() if world is None else world
+
+    @property
+    def bots(self):
+        return self.runtime.bots
+
+    async def run_websocket(self):
+        self.events = EntityQueue()
+        await run_pipeline(self.subscription, self.timed_entity, self.events)
+
+    async def create_bot(
+        self, name, emoji, x, y, handle_update, can_be_mentioned=False, roster=None
+    ):
+        return await Bot.create(
+            self.runtime, name, emoji, x, y, handle_update, can_be_mentioned, roster
+        )
 
     async def handle_message(self, message):
-        if message["type"] == "world":
-            for entity in message["payload"]["entities"]:
-                await self.handle_entity(entity)
-        else:
-            await self.handle_entity(message["payload"])
+        for entity in message_entities(message):
+            await self.handle_entity(entity)
+
+    async def timed_entity(self, entity):
+        # The app's own span, as host.py records for hosted apps. Callbacks
+        # such as Triggers.dispatch record their handlers within it.
+        start = time.perf_counter()
+        try:
+            await self.handle_entity(entity)
+        finally:
+            metrics.observe("app", time.perf_counter() - start, app=self.name)
 
     async def handle_entity(self, entity):
+        if self.owns_world:
+            self.world.update(entity)
         for callback in self.callbacks:
             await callback(entity)
 
         if entity["id"] in self.bots:
             callback = self.bots[entity["id"]].handle_entity
             if callback:
-                await callback(entity)
+                await timed(callback, entity, f"{self.name} bots")
 
     def add_callback(self, callback):
         self.callbacks.append(callback)
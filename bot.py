@@ -1,33 +1,77 @@
+import os
+import json
+import time
+import heapq
 import asyncio
-import rctogether
+import itertools
 
-# We want to avoid sending successive updates for the same pet too quickly to
-# avoid overloading the RC server.
-SLEEP_AFTER_UPDATE = 1
+import bulk
+from metrics import metrics
+from ratelimit import backoff, limiter, now, transient
+from updates import Mailbox
+
+# Number of concurrent PATCH requests, shared by every bot in the process.
+WORKERS = 4
+
+# Tries for a PATCH that fails with a network error, 429 or 5xx, including the
+# first. Each retry sends the latest state, so a failed update that has since
+# been replaced is never resent.
+UPDATE_ATTEMPTS = 5
+
+# Set RC_WARM_START=1 to take over the bots a previous run left behind rather
+# than deleting them and starting again. RC_BOTS_SNAPSHOT names a file written
+# by save_bots.py to read them from, saving a GET /api/bots.
+WARM_START = os.environ.get("RC_WARM_START", "0") != "0"
+BOTS_SNAPSHOT = os.environ.get("RC_BOTS_SNAPSHOT")
 
 
 class Bot:
-    def __init__(self, bot_json):
+    __slots__ = (
+        "bot_json",
+        "runtime",
+        "mailbox",
+        "handle_update",
+        "ready_at",
+        "queued",
+        "failures",
+        "awaiting_echo",
+    )
+
+    def __init__(self, bot_json, runtime, handle_update=None):
         self.bot_json = bot_json
-        self.queue = asyncio.Queue()
-        self.pos = bot_json["pos"]
-        self.task = None
+        self.runtime = runtime
+        self.mailbox = Mailbox()
+        self.handle_update = handle_update
+        # Earliest time the next PATCH for this bot may be sent.
+        self.ready_at = 0
+        # True while the bot is on the ready-heap or has a PATCH in flight.
+        self.queued = False
+        # PATCHes that have failed in a row.
+        self.failures = 0
+        # The position we last moved to and when, until the websocket shows it.
+        self.awaiting_echo = None
 
     @classmethod
-    async def create(cls, session, name, emoji, x, y, can_be_mentioned=False):
-        bot_json = await rctogether.bots.create(
-            session, name=name, emoji=emoji, x=x, y=y, can_be_mentioned=can_be_mentioned
-        )
-        bot = cls(bot_json)
-        bot.start_task(session)
-        return bot
+    async def create(
+        cls, runtime, name, emoji, x, y, handle_update=None, can_be_mentioned=False, roster=None
+    ):
+        """Create a bot, or take over a matching one from roster and send it to x, y."""
+        bot_json = roster.claim(name, emoji) if roster is not None else None
+        if bot_json:
+            bot = cls.adopt(runtime, bot_json, handle_update)
+            await bot.update({"x": x, "y": y})
+            return bot
 
-    async def close(self):
-        await self.queue.put(None)
-        await self.task
+        bot_json = await runtime.create_bot(
+            name=name, emoji=emoji, x=x, y=y, can_be_mentioned=can_be_mentioned
+        )
+        return cls.adopt(runtime, bot_json, handle_update)
 
-    def start_task(self, session):
-        self.task = asyncio.create_task(self.run(session))
+    @classmethod
+    def adopt(cls, runtime, bot_json, handle_update=None):
+        bot = cls(bot_json, runtime, handle_update)
+        runtime.add(bot)
+        return bot
 
     @property
     def id(self):
@@ -41,37 +85,194 @@ class Bot:
     def name(self):
         return self.bot_json["name"]
 
-    async def queued_updates(self):
-        while True:
-            update = await self.queue.get()
+    @property
+    def pos(self):
+        return self.bot_json["pos"]
 
-            while update is not None and not self.queue.empty():
-                next_update = await self.queue.get()
-                if next_update is None:
-                    yield update
-                print("Skipping outdated update: ", update)
-                update = next_update
+    async def update(self, update):
+        self.mailbox.put(update)
+        self.runtime.schedule(self)
 
-            if update is None:
-                return
+    async def destroy(self):
+        await self.runtime.destroy(self)
 
-            yield update
+    def update_data(self, data):
+        self.bot_json = data
+        if self.awaiting_echo and data.get("pos") == self.awaiting_echo[0]:
+            metrics.observe("echo", time.perf_counter() - self.awaiting_echo[1])
+            self.awaiting_echo = None
 
-    async def run(self, session):
-        async for update in self.queued_updates():
-            print("Applying update: ", update)
-            try:
-                await rctogether.bots.update(session, self.id, update)
-            except rctogether.api.HttpError as exc:
-                print(f"Update failed: {self!r}, {exc!r}")
+    async def handle_entity(self, entity):
+        self.update_data(entity)
+        if self.handle_update:
+            await self.handle_update(entity)
 
-            await asyncio.sleep(SLEEP_AFTER_UPDATE)
+    def __repr__(self):
+        return "<Bot name=%r>" % (self.name,)
 
-    async def update(self, update):
-        await self.queue.put(update)
 
-    async def destroy(self, session):
-        rctogether.bots.delete(session, self.id)
+class Roster:
+    """Bots left over from a previous run, waiting to be taken over by name and emoji."""
 
-    def update_data(self, data):
-        self.bot_json = data
+    def __init__(self, bots):
+        self.bots = list(bots)
+
+    @classmethod
+    async def load(cls, api, snapshot=None):
+        if snapshot:
+            with open(snapshot) as f:
+                return cls(json.load(f))
+        return cls(await bulk.retrying(api.get_bots, endpoint="GET /api/bots"))
+
+    def claim(self, name, emoji):
+        for bot_json in self.bots:
+            if bot_json["name"] == name and bot_json["emoji"] == emoji:
+                self.bots.remove(bot_json)
+                return bot_json
+        return None
+
+    def claim_all(self, predicate):
+        claimed = [bot_json for bot_json in self.bots if predicate(bot_json)]
+        self.bots = [bot_json for bot_json in self.bots if not predicate(bot_json)]
+        return claimed
+
+    async def release(self, api):
+        """Delete every bot nobody claimed."""
+        leftovers, self.bots = self.bots, []
+        await bulk.delete_bots(api, [bot_json["id"] for bot_json in leftovers])
+
+
+async def roster_from_env(api):
+    if WARM_START or BOTS_SNAPSHOT:
+        roster = await Roster.load(api, BOTS_SNAPSHOT)
+        print(f"Warm start: found {len(roster.bots)} existing bots")
+        return roster
+    return None
+
+
+class Runtime:
+    """Sends updates for every bot in the process.
+
+    Bots with pending updates sit on a heap ordered by the time they are next
+    allowed to send. One scheduler task moves due bots onto a ready queue and a
+    fixed pool of workers sends their PATCHes, so the number of tasks doesn't
+    grow with the number of bots."""
+
+    def __init__(self, api, workers=WORKERS, limiter=limiter):
+        self.api = api
+        self.workers = workers
+        self.limiter = limiter
+        self.bots = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.ready = asyncio.Queue()
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.tasks = []
+
+    def start(self):
+        if not self.tasks:
+            self.tasks.append(asyncio.create_task(self.schedule_loop()))
+            self.tasks.extend(asyncio.create_task(self.worker()) for _ in range(self.workers))
+
+    async def close(self):
+        """Send any pending updates, then stop the scheduler and workers."""
+        while self.active:
+            await self.idle.wait()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def add(self, bot):
+        self.bots[bot.id] = bot
+
+    def remove(self, bot):
+        self.bots.pop(bot.id, None)
+
+    async def create_bot(self, **bot_attributes):
+        return await self.limiter.request(
+            lambda: self.api.create_bot(**bot_attributes), endpoint="POST /api/bots"
+        )
+
+    async def destroy(self, bot):
+        self.remove(bot)
+        await self.limiter.request(
+            lambda: self.api.delete_bot(bot.id), endpoint="DELETE /api/bots/{bot_id}"
+        )
+
+    def schedule(self, bot):
+        if bot.queued:
+            return
+        self.start()
+        bot.queued = True
+        self.active += 1
+        self.idle.clear()
+        heapq.heappush(self.heap, (bot.ready_at, next(self.counter), bot))
+        self.wakeup.set()
+
+    async def schedule_loop(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+
+            ready_at, _, bot = self.heap[0]
+            delay = ready_at - now()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            self.ready.put_nowait(bot)
+
+    async def worker(self):
+        while True:
+            bot = await self.ready.get()
+            try:
+                await self.flush(bot)
+            finally:
+                bot.queued = False
+                self.active -= 1
+                if not bot.mailbox.empty() and bot.id in self.bots:
+                    self.schedule(bot)
+                if not self.active:
+                    self.idle.set()
+
+    async def flush(self, bot):
+        since = bot.mailbox.since
+        update = bot.mailbox.take(bot.bot_json)
+        if not update:
+            return
+        metrics.observe("mailbox", time.perf_counter() - since)
+
+        def send():
+            # Pick up anything that arrived while waiting for the budget.
+            update.update(bot.mailbox.take(bot.bot_json))
+            print("Applying update: ", update)
+            if "x" in update or "y" in update:
+                pos = {"x": update.get("x", bot.pos["x"]), "y": update.get("y", bot.pos["y"])}
+                bot.awaiting_echo = (pos, time.perf_counter())
+            return self.api.update_bot(bot.id, update)
+
+        try:
+            await self.limiter.request(send, endpoint="PATCH /api/bots/{bot_id}")
+        except Exception as exc:
+            bot.failures += 1
+            if transient(exc) and bot.failures < UPDATE_ATTEMPTS:
+                print(f"Update failed, will retry: {bot!r}, {exc!r}")
+                # Anything newer that arrived meanwhile takes precedence.
+                bot.mailbox.restore(update)
+                bot.ready_at = now() + max(self.limiter.min_interval, backoff(bot.failures))
+                return
+            # Give up. bot_json still holds what the server last told us, and
+            # the websocket will keep it up to date.
+            print(f"Update failed: {bot!r}, {exc!r}")
+            bot.mailbox.forget(update)
+        bot.failures = 0
+        bot.ready_at = now() + self.limiter.min_interval
@@ -0,0 +1,487 @@
+"""Share one RC websocket between bot apps in several processes, over a Unix socket.
+
+The broker owns the websocket and the HTTP connection pool:
+
+    python broker.py serve
+
+and workers run apps from host.py against it, each process on its own core:
+
+    python broker.py worker rocket
+    python broker.py worker quantum --region 150,0,170,30
+
+A worker gets the entities matching its subscription, plus its own bots. Its
+REST calls are carried out by the broker, so every worker shares one
+connection pool and one rate limiter.
+
+Frames are a 4 byte length and a 1 byte kind, then the payload. Entity
+updates carry the id and position as packed integers, followed by any other
+fields as JSON.
+
+To measure fan-out on localhost, without RC or the network:
+
+    python broker.py bench --workers 4 --updates 200000 --partition
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import struct
+import asyncio
+import argparse
+import itertools
+import tempfile
+
+import arctogether
+import bulk
+from bot import Runtime
+from decode import Entity, dumps, loads
+from pipeline import EntityQueue, run_pipeline
+from ratelimit import RateLimiter, limiter, status_of, transient
+from recorder import recorder_from_env
+from world import World, normalise_name
+
+SOCKET_PATH = os.environ.get("RC_BROKER_SOCKET", "/tmp/rctogether.sock")
+
+HEADER = struct.Struct("!IB")
+SUBSCRIBE, ENTITY, REQUEST, RESPONSE = range(1, 5)
+
+ENTITY_HEADER = struct.Struct("!qii")
+NO_POSITION = -(2**31)
+
+# The broker carries out these Client methods for workers.
+METHODS = {
+    "get_bots": "GET /api/bots",
+    "create_bot": "POST /api/bots",
+    "update_bot": "PATCH /api/bots/{bot_id}",
+    "delete_bot": "DELETE /api/bots/{bot_id}",
+    "send_message": "POST /api/messages",
+}
+
+# Workers leave rate limiting to the broker, but still space out each bot's
+# updates as usual.
+WORKER_RATE = 10000
+
+
+def encode_frame(kind, payload):
+    return HEADER.pack(len(payload), kind) + payload
+
+
+async def read_frame(reader):
+    length, kind = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return kind, await reader.readexactly(length)
+
+
+def encode_entity(entity):
+    data = entity.asdict()
+    del data["id"]
+    pos = data.pop("pos", None)
+    x, y = (pos["x"], pos["y"]) if pos else (NO_POSITION, NO_POSITION)
+    return encode_frame(ENTITY, ENTITY_HEADER.pack(entity.id, x, y) + dumps(data))
+
+
+def decode_entity(payload):
+    entity_id, x, y = ENTITY_HEADER.unpack_from(payload)
+    data = loads(payload[ENTITY_HEADER.size :])
+    data["id"] = entity_id
+    if x != NO_POSITION:
+        data["pos"] = {"x": x, "y": y}
+    return Entity(data)
+
+
+class Filter:
+    """Which entities a worker wants: everything, or by id, person or region.
+
+    A region matches an entity that is in it or has just left it, so that
+    workers can see people leave."""
+
+    def __init__(self, spec=None):
+        self.everything = False
+        self.ids = set()
+        self.names = set()
+        self.regions = []
+        if spec:
+            self.add(spec)
+
+    def add(self, spec):
+        self.everything = self.everything or spec.get("all", False)
+        self.ids.update(spec.get("ids", ()))
+        self.names.update(normalise_name(name) for name in spec.get("names", ()))
+        self.regions.extend(tuple(region) for region in spec.get("regions", ()))
+
+    def matches(self, entity, previous=None):
+        if self.everything or entity.id in self.ids:
+            return True
+        if self.names and normalise_name(entity.person_name) in self.names:
+            return True
+        for x0, y0, x1, y1 in self.regions:
+            for position in ((entity.x, entity.y), previous):
+                if position and position[0] is not None:
+                    if x0 <= position[0] <= x1 and y0 <= position[1] <= y1:
+                        return True
+        return False
+
+
+class WorkerConnection:
+    """The broker's end of a connection to one worker."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.filter = Filter()
+        # Encoded entity frames waiting to go out, keeping only the latest
+        # per entity if the worker falls behind.
+        self.events = EntityQueue()
+        self.calls = set()
+
+    def send(self, kind, payload):
+        self.writer.write(encode_frame(kind, payload))
+
+    async def send_entities(self):
+        while (frame := await self.events.get()) is not None:
+            self.writer.write(frame)
+            await self.writer.drain()
+        self.writer.close()
+
+
+class Broker:
+    def __init__(self, api, limiter=limiter):
+        self.api = api
+        self.limiter = limiter
+        self.world = World()
+        self.workers = set()
+
+    async def serve(self, path=SOCKET_PATH):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle_worker, path)
+        print(f"Broker listening on {path}")
+        return server
+
+    async def handle_worker(self, reader, writer):
+        worker = WorkerConnection(writer)
+        self.workers.add(worker)
+        sender = asyncio.create_task(worker.send_entities())
+        try:
+            while True:
+                try:
+                    kind, payload = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if kind == SUBSCRIBE:
+                    self.subscribe(worker, loads(payload))
+                elif kind == REQUEST:
+                    task = asyncio.create_task(self.call(worker, loads(payload)))
+                    worker.calls.add(task)
+                    task.add_done_callback(worker.calls.discard)
+                else:
+                    print("Unknown frame kind from worker: ", kind)
+        finally:
+            self.workers.discard(worker)
+            sender.cancel()
+            # Nobody is left to hear the answers.
+            for task in worker.calls:
+                task.cancel()
+            writer.close()
+
+    def subscribe(self, worker, spec):
+        worker.filter.add(spec)
+        # Catch the worker up with what we already know, as the server does
+        # with a world snapshot.
+        new = Filter(spec)
+        for entity in self.world.entities.values():
+            if new.matches(entity):
+                worker.events.put(encode_entity(entity), entity.id)
+
+    async def call(self, worker, request):
+        method = request["method"]
+        try:
+            if method not in METHODS:
+                raise arctogether.HttpError(400, f"Unknown method {method}")
+            result = await self.limiter.request(
+                lambda: getattr(self.api, method)(**request["args"]), endpoint=METHODS[method]
+            )
+        except Exception as exc:
+            status = status_of(exc) or (503 if transient(exc) else 500)
+            response = {"id": request["id"], "error": [status, repr(exc)]}
+        else:
+            if method == "create_bot":
+                # Workers always hear about their own bots.
+                worker.filter.ids.add(result["id"])
+            response = {"id": request["id"], "result": result}
+        worker.send(RESPONSE, dumps(response))
+
+    async def handle_entity(self, entity):
+        old = self.world.get(entity["id"])
+        previous = (old.x, old.y) if old is not None else None
+        entity = self.world.update(entity)
+
+        frame = None
+        for worker in self.workers:
+            if worker.filter.matches(entity, previous):
+                if frame is None:
+                    frame = encode_entity(entity)
+                worker.events.put(frame, entity.id)
+
+    async def run(self, entities):
+        try:
+            await run_pipeline(entities, self.handle_entity)
+        finally:
+            # Let workers finish reading, then hang up.
+            for worker in self.workers:
+                worker.events.close()
+
+
+class RemoteError(Exception):
+    """An error from a request the broker made for us: (status, description)."""
+
+
+class BrokerConnection:
+    """A worker's connection to the broker.
+
+    An async iterator of the entities the worker subscribed to, which can
+    stand in for arctogether.Subscription, and the Client bot methods, which
+    the broker carries out."""
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+        self.writer = None
+        self.entities = asyncio.Queue()
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.reader_task = None
+        # Set once the broker hangs up, after which requests fail at once.
+        self.closed = False
+
+    async def connect(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.reader_task = asyncio.create_task(self.read_frames(reader))
+
+    async def close(self):
+        self.writer.close()
+        self.reader_task.cancel()
+
+    async def read_frames(self, reader):
+        try:
+            while True:
+                kind, payload = await read_frame(reader)
+                if kind == ENTITY:
+                    self.entities.put_nowait(decode_entity(payload))
+                elif kind == RESPONSE:
+                    response = loads(payload)
+                    future = self.pending.pop(response["id"])
+                    if "error" in response:
+                        future.set_exception(RemoteError(*response["error"]))
+                    else:
+                        future.set_result(response["result"])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Broker connection closed.")
+        finally:
+            self.closed = True
+            self.entities.put_nowait(None)
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Broker connection closed"))
+            self.pending = {}
+
+    def subscribe(self, everything=False, ids=(), names=(), regions=()):
+        spec = {"all": everything, "ids": list(ids), "names": list(names), "regions": regions}
+        self.writer.write(encode_frame(SUBSCRIBE, dumps(spec)))
+
+    async def __aiter__(self):
+        while (entity := await self.entities.get()) is not None:
+            yield entity
+
+    async def request(self, method, **args):
+        if self.closed:
+            raise ConnectionError("Broker connection closed")
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        request = {"id": request_id, "method": method, "args": args}
+        self.writer.write(encode_frame(REQUEST, dumps(request)))
+        return await future
+
+    async def get_bots(self):
+        return await self.request("get_bots")
+
+    async def create_bot(self, name, emoji, x=5, y=2, direction="right", can_be_mentioned=False):
+        return await self.request(
+            "create_bot",
+            name=name,
+            emoji=emoji,
+            x=x,
+            y=y,
+            direction=direction,
+            can_be_mentioned=can_be_mentioned,
+        )
+
+    async def update_bot(self, bot_id, bot_attributes):
+        return await self.request("update_bot", bot_id=bot_id, bot_attributes=bot_attributes)
+
+    async def delete_bot(self, bot_id):
+        return await self.request("delete_bot", bot_id=bot_id)
+
+    async def send_message(self, bot_id, message_text):
+        return await self.request("send_message", bot_id=bot_id, message_text=message_text)
+
+
+def worker_limiter():
+    return RateLimiter(
+        rate=WORKER_RATE, burst=WORKER_RATE, min_rate=WORKER_RATE, max_rate=WORKER_RATE
+    )
+
+
+def parse_region(text):
+    return [int(value) for value in text.split(",")]
+
+
+async def serve(args):
+    async with arctogether.Client() as client:
+        broker = Broker(client)
+        server = await broker.serve(args.socket)
+        recorder = recorder_from_env()
+        try:
+            await bulk.delete_all(client)
+            await broker.run(arctogether.Subscription(recorder))
+        finally:
+            server.close()
+            if recorder:
+                recorder.close()
+            await bulk.delete_all(client)
+
+
+async def run_worker(args):
+    from host import AppHost
+
+    connection = BrokerConnection(args.socket)
+    await connection.connect()
+    if args.region or args.person:
+        connection.subscribe(regions=args.region, names=args.person)
+    else:
+        connection.subscribe(everything=True)
+
+    runtime = Runtime(connection, limiter=worker_limiter())
+    host = AppHost(runtime, subscription=connection)
+    try:
+        for name in args.apps:
+            await host.add(name)
+        await host.run()
+    finally:
+        print("App stats: ", host.stats())
+        await runtime.close()
+        # If the broker has gone, its delete_all has cleaned up after us.
+        if not connection.closed:
+            await bulk.delete_bots(connection, list(runtime.bots))
+        await connection.close()
+
+
+async def count(args):
+    """Count entities until the broker hangs up, for bench."""
+    connection = BrokerConnection(args.socket)
+    await connection.connect()
+    if args.region:
+        connection.subscribe(regions=args.region)
+    else:
+        connection.subscribe(everything=True)
+    received = 0
+    start = None
+    async for _ in connection:
+        if start is None:
+            start = time.perf_counter()
+        received += 1
+    elapsed = time.perf_counter() - start if start else 0
+    print(json.dumps({"received": received, "elapsed": elapsed}))
+
+
+async def bench(args):
+    from fakeserver import InMemoryApi
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    broker = Broker(InMemoryApi())
+    server = await broker.serve(path)
+
+    workers = []
+    for i in range(args.workers):
+        command = [sys.executable, __file__, "count", "--socket", path]
+        if args.partition:
+            # Give each worker its own vertical strip of the space.
+            width = args.width // args.workers
+            command += ["--region", f"{i * width},0,{(i + 1) * width - 1},{args.height}"]
+        workers.append(
+            await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+        )
+    while len(broker.workers) < args.workers:
+        await asyncio.sleep(0.05)
+
+    async def updates():
+        for n in range(args.updates):
+            yield {
+                "id": n % args.people + 1,
+                "type": "Avatar",
+                "person_name": f"Person {n % args.people}",
+                "pos": {"x": random.randrange(args.width), "y": random.randrange(args.height)},
+            }
+            if n % 100 == 0:
+                # Let the broker's dispatcher and senders keep up.
+                await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await broker.run(updates())
+    # Each worker prints its count last.
+    outputs = [(await worker.communicate())[0] for worker in workers]
+    results = [json.loads(output.splitlines()[-1]) for output in outputs]
+    elapsed = time.perf_counter() - start
+    server.close()
+
+    delivered = sum(result["received"] for result in results)
+    print(
+        json.dumps(
+            {
+                "updates": args.updates,
+                "workers": args.workers,
+                "elapsed": elapsed,
+                "updates_per_sec": args.updates / elapsed,
+                "delivered": delivered,
+                "delivered_per_sec": delivered / elapsed,
+                "per_worker": results,
+            },
+            indent=2,
+        )
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Fan RC events out to worker processes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="own the websocket and serve workers")
+    serve_parser.add_argument("--socket", default=SOCKET_PATH)
+
+    worker_parser = commands.add_parser("worker", help="run host.py apps against the broker")
+    worker_parser.add_argument("apps", nargs="+")
+    worker_parser.add_argument("--socket", default=SOCKET_PATH)
+    worker_parser.add_argument(
+        "--region", type=parse_region, action="append", default=[], help="x0,y0,x1,y1"
+    )
+    worker_parser.add_argument("--person", action="append", default=[])
+
+    count_parser = commands.add_parser("count", help="count entities, for bench")
+    count_parser.add_argument("--socket", default=SOCKET_PATH)
+    count_parser.add_argument("--region", type=parse_region, action="append", default=[])
+
+    bench_parser = commands.add_parser("bench", help="measure fan-out on localhost")
+    bench_parser.add_argument("--workers", type=int, default=4)
+    bench_parser.add_argument("--updates", type=int, default=100000)
+    bench_parser.add_argument("--people", type=int, default=1000)
+    bench_parser.add_argument("--width", type=int, default=200)
+    bench_parser.add_argument("--height", type=int, default=100)
+    bench_parser.add_argument("--partition", action="store_true", help="one region per worker")
+
+    args = parser.parse_args()
+    commands = {"serve": serve, "worker": run_worker, "count": count, "bench": bench}
+    await commands[args.command](args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,157 @@
+"""Create, update or delete many bots at once.
+
+Requests go out from a fixed number of workers, paced by the shared rate
+limiter, which adapts to how the server is coping. Each item that fails
+with a network error, a 429 or a 5xx is retried with backoff, and a summary of
+what happened comes back at the end.
+
+    result = await bulk.delete_bots(api, [bot["id"] for bot in bots])
+    print(result.summary())
+
+api is anything with the arctogether.Client bot methods, e.g. arctogether.Client
+or broker.BrokerConnection.
+"""
+
+import time
+import asyncio
+
+from ratelimit import backoff, limiter, status_of, transient
+
+# Requests in flight at once.
+CONCURRENCY = 8
+# Tries per item, including the first.
+ATTEMPTS = 4
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 2
+
+
+async def retrying(call, attempts=ATTEMPTS, limiter=limiter, on_retry=None, endpoint=None):
+    """Await call() until it succeeds, it fails in a way that won't improve, or
+    we run out of attempts."""
+    for tries in range(1, attempts + 1):
+        try:
+            return await limiter.request(call, endpoint=endpoint)
+        except Exception as exc:
+            if tries == attempts or not transient(exc):
+                raise
+            if on_retry:
+                on_retry(exc)
+            await asyncio.sleep(backoff(tries))
+
+
+class BulkResult:
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.results = []
+        self.failures = []
+        self.retries = 0
+        self.start = time.perf_counter()
+        self.elapsed = None
+
+    @property
+    def done(self):
+        return len(self.results) + len(self.failures)
+
+    def progress(self):
+        return (
+            f"{self.label}: {self.done}/{self.total} done, "
+            f"{len(self.failures)} failed, {self.retries} retries"
+        )
+
+    def summary(self):
+        return {
+            "operation": self.label,
+            "total": self.total,
+            "succeeded": len(self.results),
+            "failed": len(self.failures),
+            "retries": self.retries,
+            "elapsed": self.elapsed,
+            "errors": [repr(exc) for _, exc in self.failures[:10]],
+        }
+
+
+async def run_bulk(
+    operation,
+    items,
+    label="bulk",
+    endpoint=None,
+    concurrency=CONCURRENCY,
+    attempts=ATTEMPTS,
+    limiter=limiter,
+    progress_interval=PROGRESS_INTERVAL,
+):
+    """Call operation(item) for every item and collect the outcomes in a BulkResult."""
+    items = list(items)
+    result = BulkResult(label, len(items))
+    pending = iter(items)
+
+    def count_retry(exc):
+        result.retries += 1
+
+    async def worker():
+        # Every worker shares one iterator, so each item is taken exactly once.
+        for item in pending:
+            try:
+                result.results.append(
+                    await retrying(
+                        lambda: operation(item), attempts, limiter, count_retry, endpoint
+                    )
+                )
+            except Exception as exc:
+                result.failures.append((item, exc))
+
+    async def report():
+        while True:
+            await asyncio.sleep(progress_interval)
+            print(result.progress())
+
+    reporter = asyncio.create_task(report())
+    try:
+        await asyncio.gather(*[worker() for _ in range(min(concurrency, len(items)))])
+    finally:
+        reporter.cancel()
+    result.elapsed = time.perf_counter() - result.start
+    print(result.progress())
+    return result
+
+
+async def create_bots(api, bots, **options):
+    """Create a bot for each dict of create_bot arguments."""
+    return await run_bulk(
+        lambda bot: api.create_bot(**bot), bots, "create bots", "POST /api/bots", **options
+    )
+
+
+async def update_bots(api, updates, **options):
+    """Apply each (bot_id, bot_attributes) pair."""
+    return await run_bulk(
+        lambda update: api.update_bot(*update),
+        updates,
+        "update bots",
+        "PATCH /api/bots/{bot_id}",
+        **options,
+    )
+
+
+async def delete_bots(api, bot_ids, **options):
+    async def delete(bot_id):
+        try:
+            return await api.delete_bot(bot_id)
+        except Exception as exc:
+            # Already gone, which is all we wanted.
+            if status_of(exc) != 404:
+                raise
+            return None
+
+    return await run_bulk(delete, bot_ids, "delete bots", "DELETE /api/bots/{bot_id}", **options)
+
+
+async def delete_all(api, **options):
+    bots = await retrying(
+        api.get_bots, limiter=options.get("limiter", limiter), endpoint="GET /api/bots"
+    )
+    result = await delete_bots(api, [bot["id"] for bot in bots], **options)
+    for bot_id, exc in result.failures:
+        print(f"Failed to delete bot {bot_id}: {exc!r}")
+    return result
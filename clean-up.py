@@ -1,14 +1,15 @@
-import asyncio
-import rctogether
+import arctogether
+import bulk
+from syncclient import SyncClient
 
-async def main():
-    async with rctogether.RestApiSession() as session:
-        # Refuse to clean up pets.
-        if session.rc_app_id.startswith("c37fb"):
-            raise ValueError("No! People care about pets")
+def main():
+    # Refuse to clean up pets.
+    if arctogether.RC_APP_ID.startswith("c37fb"):
+        raise ValueError("No! People care about pets")
 
-        for bot in await rctogether.bots.get(session):
-            await rctogether.bots.delete(session, bot['id'])
+    with SyncClient() as client:
+        result = client.bulk(bulk.delete_all)
+        print(result.summary())
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
@@ -0,0 +1,109 @@
+import json
+
+try:
+    import orjson
+
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    loads = json.loads
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+# ActionCable pings arrive every few seconds and are never interesting, so we
+# recognise them without parsing.
+PING_PREFIXES = ('{"type":"ping"', b'{"type":"ping"')
+
+
+def is_ping(frame):
+    return frame.startswith(PING_PREFIXES[isinstance(frame, bytes)])
+
+
+class Entity:
+    """The parts of an RC Together entity that the bots look at.
+
+    Supports the dict style access (entity["pos"], entity.get("person_name"))
+    the handlers already use, without keeping every field of every entity in a
+    large space around as a dict."""
+
+    __slots__ = (
+        "id",
+        "type",
+        "x",
+        "y",
+        "name",
+        "person_name",
+        "emoji",
+        "note_text",
+        "updated_by",
+        "message",
+    )
+    FIELDS = frozenset(__slots__) - {"x", "y"}
+
+    def __init__(self, data):
+        pos = data.get("pos") or {}
+        self.id = data["id"]
+        self.type = data.get("type")
+        self.x = pos.get("x")
+        self.y = pos.get("y")
+        self.name = data.get("name")
+        self.person_name = data.get("person_name")
+        self.emoji = data.get("emoji")
+        self.note_text = data.get("note_text")
+        self.updated_by = data.get("updated_by")
+        self.message = data.get("message")
+
+    @property
+    def pos(self):
+        if self.x is None:
+            return None
+        return {"x": self.x, "y": self.y}
+
+    def get(self, key, default=None):
+        if key == "pos":
+            value = self.pos
+        elif key in self.FIELDS:
+            value = getattr(self, key)
+        else:
+            value = None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def asdict(self):
+        """The entity as a dict in the shape the server sends."""
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        data["pos"] = self.pos
+        return {key: value for key, value in data.items() if value is not None}
+
+    def astuple(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, Entity):
+            return NotImplemented
+        return self.astuple() == other.astuple()
+
+    def __repr__(self):
+        fields = ", ".join(
+            f"{field}={getattr(self, field)!r}"
+            for field in self.__slots__
+            if getattr(self, field) is not None
+        )
+        return f"Entity({fields})"
+
+
+def message_entities(message, wants=None):
+    """Entity records for a channel message, skipping any raw entity dict that
+    wants(entity) turns down before the record is built."""
+    if message["type"] == "world":
+        entities = message["payload"]["entities"]
+    else:
+        entities = [message["payload"]]
+    return [Entity(entity) for entity in entities if wants is None or wants(entity)]
@@ -0,0 +1,368 @@
+"""Benchmark the demos' concurrency models against a local stand-in server.
+
+The demos each create snakes a different way: one after another (demo.py),
+on OS threads (demo-threads.py), on green threads (demo-eventlet.py) or with
+asyncio (demo-async.py). This creates N snakes with each model, with and
+without a pooled session, against fakeserver.py with injected latency, and
+writes throughput, latency percentiles and peak memory as JSON:
+
+    python demos/benchmark.py --output results.json
+    python demos/benchmark.py --n 10 100 --models threads asyncio --latency 0.05
+    python demos/benchmark.py --output after.json --compare results.json
+
+Every run is a separate process, so that eventlet's monkey patching doesn't
+leak into the other models and peak memory is measured per run.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import subprocess
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+MODELS = ("sequential", "threads", "greenlets", "asyncio")
+# Modules each model needs that may not be installed.
+REQUIRES = {
+    "sequential": ["requests"],
+    "threads": ["requests"],
+    "greenlets": ["requests", "eventlet"],
+    "asyncio": ["aiohttp"],
+}
+SIZES = (10, 100, 1000)
+# Most requests in flight at once, for every concurrent model.
+CONCURRENCY = 100
+# Seconds the stand-in server adds to every request, plus up to JITTER more.
+LATENCY = 0.02
+JITTER = 0.01
+# Requests sent before timing starts.
+WARMUP = 10
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def snake():
+    return {
+        "bot": {
+            "name": "Benchmarksssss!",
+            "emoji": "🐍",
+            "x": random.randint(142, 175),
+            "y": random.randint(1, 40),
+            "direction": "right",
+            "can_be_mentioned": False,
+        }
+    }
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Timings:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+
+    def record(self, start, ok):
+        self.latencies.append(time.perf_counter() - start)
+        if not ok:
+            self.errors += 1
+
+
+def requests_session(pooled, concurrency):
+    import requests
+
+    if not pooled:
+        return requests
+    session = requests.Session()
+    # Enough keep-alive connections for every thread or greenlet to have one.
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    return session
+
+
+def post_snake(session, url, timings):
+    start = time.perf_counter()
+    try:
+        ok = session.post(url, json=snake()).status_code == 200
+    except OSError:
+        ok = False
+    timings.record(start, ok)
+
+
+# Each model's setup imports its libraries and makes any sessions, pools and
+# event loop, outside the timed run. It returns run(n, timings), which creates
+# n snakes, and close().
+
+
+def setup_sequential(url, pooled, concurrency):
+    session = requests_session(pooled, 1)
+
+    def run(n, timings):
+        for _ in range(n):
+            post_snake(session, url, timings)
+
+    return run, lambda: None
+
+
+def setup_threads(url, pooled, concurrency):
+    session = requests_session(pooled, concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def run(n, timings):
+        futures = [executor.submit(post_snake, session, url, timings) for _ in range(n)]
+        for future in futures:
+            future.result()
+
+    return run, executor.shutdown
+
+
+def setup_greenlets(url, pooled, concurrency):
+    import eventlet
+
+    session = requests_session(pooled, concurrency)
+    pool = eventlet.GreenPool(concurrency)
+
+    def run(n, timings):
+        for _ in range(n):
+            pool.spawn_n(post_snake, session, url, timings)
+        pool.waitall()
+
+    return run, lambda: None
+
+
+def setup_asyncio(url, pooled, concurrency):
+    import aiohttp
+
+    loop = asyncio.new_event_loop()
+
+    async def make_session():
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+
+    shared = loop.run_until_complete(make_session())
+
+    async def post(session, timings):
+        start = time.perf_counter()
+        try:
+            async with session.post(url, json=snake()) as response:
+                await response.read()
+                ok = response.status == 200
+        except (OSError, aiohttp.ClientError):
+            ok = False
+        timings.record(start, ok)
+
+    async def create_snakes(n, timings):
+        limit = asyncio.Semaphore(concurrency)
+
+        async def create_snake():
+            async with limit:
+                if pooled:
+                    await post(shared, timings)
+                else:
+                    async with aiohttp.ClientSession() as session:
+                        await post(session, timings)
+
+        await asyncio.gather(*(create_snake() for _ in range(n)))
+
+    def run(n, timings):
+        loop.run_until_complete(create_snakes(n, timings))
+
+    def close():
+        loop.run_until_complete(shared.close())
+        loop.close()
+
+    return run, close
+
+
+SETUPS = {
+    "sequential": setup_sequential,
+    "threads": setup_threads,
+    "greenlets": setup_greenlets,
+    "asyncio": setup_asyncio,
+}
+
+
+def run_one(model, url, n, pooled, concurrency):
+    """Create n snakes with one model, in this process, and print the result."""
+    if model == "greenlets":
+        # Before requests and socket are imported anywhere.
+        import eventlet
+
+        eventlet.monkey_patch()
+
+    run, close = SETUPS[model](url, pooled, concurrency)
+    # Untimed, so that first-request costs (lazy imports, DNS, opening the
+    # pool's connections) don't count against small runs.
+    run(WARMUP, Timings())
+    timings = Timings()
+    start = time.perf_counter()
+    run(n, timings)
+    elapsed = time.perf_counter() - start
+    close()
+    result = {
+        "model": model,
+        "pooled": pooled,
+        "n": n,
+        "elapsed": elapsed,
+        "throughput": n / elapsed,
+        "p50": percentile(timings.latencies, 50),
+        "p99": percentile(timings.latencies, 99),
+        "errors": timings.errors,
+        # Kilobytes on Linux.
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    print(json.dumps(result))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(latency, jitter):
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "fakeserver.py",
+            "--host=127.0.0.1",
+            f"--port={port}",
+            f"--latency={latency}",
+            f"--jitter={jitter}",
+        ],
+        cwd=REPO,
+        stdout=subprocess.DEVNULL,
+        env={**os.environ, "RC_APP_ID": "bench", "RC_APP_SECRET": "bench"},
+    )
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError("Stand-in server didn't start")
+            time.sleep(0.1)
+    return server, f"http://127.0.0.1:{port}/api/bots?app_id=bench&app_secret=bench"
+
+
+def run_all(args):
+    models = []
+    for model in args.models:
+        missing = [name for name in REQUIRES[model] if importlib.util.find_spec(name) is None]
+        if missing:
+            print(f"Skipping {model}: needs {', '.join(missing)}")
+        else:
+            models.append(model)
+
+    server, url = start_server(args.latency, args.jitter)
+    results = []
+    try:
+        for n in args.n:
+            for model in models:
+                for pooled in (False, True):
+                    command = [
+                        sys.executable,
+                        os.path.abspath(__file__),
+                        "--run",
+                        model,
+                        "--url",
+                        url,
+                        "--n",
+                        str(n),
+                        "--concurrency",
+                        str(args.concurrency),
+                    ]
+                    if pooled:
+                        command.append("--pooled")
+                    output = subprocess.run(command, capture_output=True, text=True, check=True)
+                    result = json.loads(output.stdout.splitlines()[-1])
+                    print(format_result(result))
+                    results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        "settings": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "concurrency": args.concurrency,
+            "warmup": WARMUP,
+            "python": sys.version.split()[0],
+        },
+        "results": results,
+    }
+
+
+def key(result):
+    return (result["model"], result["pooled"], result["n"])
+
+
+def format_result(result):
+    pooled = "pooled" if result["pooled"] else "unpooled"
+    return (
+        f"{result['model']:>10} {pooled:>8} n={result['n']:<5} "
+        f"{result['throughput']:8.1f}/s p99={result['p99'] * 1000:7.1f}ms "
+        f"peak={result['peak_rss_kb'] / 1024:6.1f}MB errors={result['errors']}"
+    )
+
+
+def compare(report, baseline):
+    """Print each result's change from the matching result in baseline."""
+    before = {key(result): result for result in baseline["results"]}
+    print("Change from baseline:")
+    for result in report["results"]:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        pooled = "pooled" if result["pooled"] else "unpooled"
+        print(
+            f"{result['model']:>10} {pooled:>8} n={result['n']:<5} "
+            f"throughput {result['throughput'] / old['throughput'] - 1:+7.1%} "
+            f"p99 {result['p99'] / old['p99'] - 1:+7.1%} "
+            f"peak {result['peak_rss_kb'] / old['peak_rss_kb'] - 1:+7.1%}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--n", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument("--jitter", type=float, default=JITTER)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with results from an earlier --output")
+    # Used by run_all to benchmark one model in a fresh process.
+    parser.add_argument("--run", choices=MODELS, help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    parser.add_argument("--pooled", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(args.run, args.url, args.n[0], args.pooled, args.concurrency)
+        return
+
+    report = run_all(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
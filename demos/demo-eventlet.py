@@ -44,7 +44,7 @@ def main():
         threads.append(gt)
 
     for t in threads:
-         gt.wait()
+        t.wait()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,302 @@
+"""A local stand-in for the RC Together server, for load testing.
+
+Serves the /api/bots and /api/messages REST endpoints and the /cable
+ActionCable websocket. Point the bots at it with:
+
+    RC_ENDPOINT=localhost:8080 RC_SSL=0 python quantum.py
+"""
+
+import json
+import math
+import random
+import asyncio
+import argparse
+import itertools
+from collections import Counter
+
+from aiohttp import web, WSMsgType
+
+from ratelimit import TokenBucket, now
+
+PING_INTERVAL = 3
+
+
+class InMemoryApi:
+    """An in-process backend with the same interface as arctogether.Client.
+
+    For running bot logic without any network at all, e.g. when replaying a
+    websocket capture. If given, echo is called with each created or updated
+    bot, standing in for the websocket message the real server would send."""
+
+    def __init__(self, echo=None):
+        self.ids = itertools.count(1)
+        self.bots = {}
+        self.stats = Counter()
+        self.echo = echo
+
+    async def get_bots(self):
+        self.stats["GET /api/bots"] += 1
+        return list(self.bots.values())
+
+    async def create_bot(self, name, emoji, x=5, y=2, direction="right", can_be_mentioned=False):
+        self.stats["POST /api/bots"] += 1
+        bot = {
+            "id": next(self.ids),
+            "type": "Bot",
+            "name": name,
+            "emoji": emoji,
+            "pos": {"x": x, "y": y},
+            "direction": direction,
+            "can_be_mentioned": can_be_mentioned,
+        }
+        self.bots[bot["id"]] = bot
+        if self.echo:
+            self.echo(dict(bot))
+        return bot
+
+    async def update_bot(self, bot_id, bot_attributes):
+        self.stats["PATCH /api/bots/{bot_id}"] += 1
+        bot = self.bots[bot_id]
+        for key, value in bot_attributes.items():
+            if key in ("x", "y"):
+                bot["pos"] = {**bot["pos"], key: value}
+            else:
+                bot[key] = value
+        if self.echo:
+            self.echo(dict(bot))
+        return bot
+
+    async def delete_bot(self, bot_id):
+        self.stats["DELETE /api/bots/{bot_id}"] += 1
+        del self.bots[bot_id]
+        return {}
+
+    async def send_message(self, bot_id, message_text):
+        self.stats["POST /api/messages"] += 1
+        return {"text": message_text}
+
+
+class FakeRcTogether:
+    def __init__(
+        self, latency=0, jitter=0, error_rate=0, rate_limit=None, burst=10, world_interval=None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.world_interval = world_interval
+
+        self.ids = itertools.count(1)
+        self.entities = {}
+        self.subscribers = {}
+        self.stats = Counter()
+        # Websocket sends in progress, kept so that they aren't garbage
+        # collected before they finish.
+        self.sending = set()
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.simulate_conditions])
+        app.add_routes(
+            [
+                web.get("/api/bots", self.get_bots),
+                web.post("/api/bots", self.create_bot),
+                web.patch("/api/bots/{bot_id}", self.update_bot),
+                web.delete("/api/bots/{bot_id}", self.delete_bot),
+                web.post("/api/messages", self.send_message),
+                web.get("/cable", self.cable),
+                web.get("/fake/stats", self.get_stats),
+                web.post("/fake/entities", self.put_entity),
+            ]
+        )
+        app.on_startup.append(self.start_background_tasks)
+        return app
+
+    @web.middleware
+    async def simulate_conditions(self, request, handler):
+        resource = request.match_info.route.resource
+        if not request.path.startswith("/api/") or resource is None:
+            # Anything else, including a 404 for an unknown /api/ path.
+            return await handler(request)
+
+        self.stats[f"{request.method} {resource.canonical}"] += 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+        if self.throttle:
+            at = now()
+            self.throttle.refill(at)
+            if self.throttle.tokens < 1:
+                self.stats["429"] += 1
+                retry_after = math.ceil((1 - self.throttle.tokens) / self.throttle.rate)
+                return web.Response(
+                    status=429, text="Too many requests", headers={"Retry-After": str(retry_after)}
+                )
+            self.throttle.tokens -= 1
+
+        if random.random() < self.error_rate:
+            self.stats["500"] += 1
+            return web.Response(status=500, text="Injected failure")
+
+        return await handler(request)
+
+    def bot_or_404(self, request):
+        bot_id = int(request.match_info["bot_id"])
+        entity = self.entities.get(bot_id)
+        if entity is None or entity["type"] != "Bot":
+            raise web.HTTPNotFound(text=f"No bot {bot_id}")
+        return entity
+
+    async def get_bots(self, request):
+        return web.json_response([e for e in self.entities.values() if e["type"] == "Bot"])
+
+    async def create_bot(self, request):
+        attributes = (await request.json())["bot"]
+        entity = {
+            "id": next(self.ids),
+            "type": "Bot",
+            "name": attributes.get("name"),
+            "emoji": attributes.get("emoji", "🤖"),
+            "pos": {"x": attributes.get("x", 0), "y": attributes.get("y", 0)},
+            "direction": attributes.get("direction", "right"),
+            "can_be_mentioned": attributes.get("can_be_mentioned", False),
+        }
+        self.entities[entity["id"]] = entity
+        self.broadcast_entity(entity)
+        return web.json_response(entity)
+
+    async def update_bot(self, request):
+        entity = self.bot_or_404(request)
+        attributes = (await request.json())["bot"]
+        for key, value in attributes.items():
+            if key in ("x", "y"):
+                entity["pos"] = {**entity["pos"], key: value}
+            else:
+                entity[key] = value
+        self.broadcast_entity(entity)
+        return web.json_response(entity)
+
+    async def delete_bot(self, request):
+        entity = self.bot_or_404(request)
+        del self.entities[entity["id"]]
+        return web.json_response({})
+
+    async def send_message(self, request):
+        data = await request.json()
+        entity = self.entities.get(data["bot_id"])
+        if entity is None:
+            raise web.HTTPNotFound(text=f"No bot {data['bot_id']}")
+        entity["message"] = {"text": data["text"], "sent_at": now()}
+        self.broadcast_entity(entity)
+        return web.json_response(entity["message"])
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def put_entity(self, request):
+        """Create or move a non-bot entity, such as a person or a note."""
+        entity = await request.json()
+        if "id" not in entity:
+            entity["id"] = next(self.ids)
+        entity.setdefault("type", "Avatar")
+        self.entities[entity["id"]] = {**self.entities.get(entity["id"], {}), **entity}
+        self.broadcast_entity(self.entities[entity["id"]])
+        return web.json_response(self.entities[entity["id"]])
+
+    def world_message(self):
+        return {"type": "world", "payload": {"entities": list(self.entities.values())}}
+
+    def broadcast_entity(self, entity):
+        self.broadcast({"type": "entity", "payload": entity})
+
+    def broadcast(self, message):
+        for connection, identifier in self.subscribers.items():
+            self.send(connection, identifier, message)
+
+    def send(self, connection, identifier, message):
+        self.stats["frames"] += 1
+        frame = json.dumps({"identifier": identifier, "message": message})
+        self.start_sending(connection.send_str(frame))
+
+    def start_sending(self, send):
+        task = asyncio.create_task(send)
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def cable(self, request):
+        connection = web.WebSocketResponse()
+        await connection.prepare(request)
+        await connection.send_json({"type": "welcome"})
+
+        try:
+            async for msg in connection:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                data = json.loads(msg.data)
+                if data.get("command") != "subscribe":
+                    continue
+                identifier = data["identifier"]
+                if json.loads(identifier).get("channel") != "ApiChannel":
+                    await connection.send_json(
+                        {"identifier": identifier, "type": "reject_subscription"}
+                    )
+                    continue
+                await connection.send_json(
+                    {"identifier": identifier, "type": "confirm_subscription"}
+                )
+                self.subscribers[connection] = identifier
+                self.send(connection, identifier, self.world_message())
+        finally:
+            self.subscribers.pop(connection, None)
+
+        return connection
+
+    async def start_background_tasks(self, app):
+        app["pinger"] = asyncio.create_task(self.ping())
+        if self.world_interval:
+            app["world"] = asyncio.create_task(self.broadcast_world())
+
+    async def ping(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            for connection in list(self.subscribers):
+                self.start_sending(connection.send_json({"type": "ping", "message": int(now())}))
+
+    async def broadcast_world(self):
+        while True:
+            await asyncio.sleep(self.world_interval)
+            self.broadcast(self.world_message())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0, help="random extra latency, up to")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of 500 responses")
+    parser.add_argument("--rate-limit", type=float, help="requests/second before returning 429")
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument("--world-interval", type=float, help="seconds between world broadcasts")
+    args = parser.parse_args()
+
+    server = FakeRcTogether(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        burst=args.burst,
+        world_interval=args.world_interval,
+    )
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Fake RC Together listening on {args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,22 +1,67 @@
-import asyncio
-import rctogether
 import random
 
+import bulk
+from bot import Bot
+from syncclient import SyncClient
+
 COSTUMES = ["👻", "🦇", "🧟", "🎃"]
+# The costumer's own bot when hosted, which it dresses up once it appears.
+TRICK_OR_TREATER = "Trick-or-Treater"
+TRICK_OR_TREATER_HOME = {"x": 12, "y": 4}
+
+def costume_for(bot):
+    """A costume for bot, or None if it's already dressed up or is the genie."""
+    if bot['emoji'] in COSTUMES or bot['emoji'] == '🧞':
+        return None
+    return random.choice(COSTUMES)
+
+class Costumer:
+    """Dresses up each of its own bots the first time it's seen, for host.py.
+
+    Other hosted apps' bots are left alone, since rocket and quantum rely on
+    their bots' emoji."""
+
+    def __init__(self, runtime, bots=()):
+        self.runtime = runtime
+        self.bots = {bot.id: bot for bot in bots}
+        self.seen = set()
 
-async def main():
-    async with rctogether.RestApiSession() as session:
-        bots = await rctogether.bots.get(session)
+    @classmethod
+    async def create(cls, runtime, roster=None):
+        """A costumer with its trick-or-treater, taken over from roster if there
+        is one there, in whatever costume it had on."""
+        bots = []
+        if roster is not None:
+            leftovers = roster.claim_all(lambda bot_json: bot_json['name'] == TRICK_OR_TREATER)
+            bots = [Bot.adopt(runtime, bot_json) for bot_json in leftovers]
+        if not bots:
+            home = TRICK_OR_TREATER_HOME
+            bots = [await Bot.create(runtime, TRICK_OR_TREATER, '🧒', home['x'], home['y'])]
+        return cls(runtime, bots)
+
+    async def handle_entity(self, entity):
+        bot = self.bots.get(entity['id'])
+        if bot is None or bot.id in self.seen:
+            return
+        self.seen.add(bot.id)
+        costume = costume_for(entity)
+        if costume:
+            await bot.update({'emoji': costume})
+
+def main():
+    with SyncClient() as client:
+        bots = client.get_bots()
+        updates = []
         for bot in bots:
-            if bot['emoji'] in COSTUMES:
-                continue
             print(bot)
-            if bot['emoji'] == '🧞':
+            costume = costume_for(bot)
+            if costume is None:
                 continue
-            costume = random.choice(COSTUMES)
             print(costume)
-            await rctogether.bots.update(session, bot['id'], {'emoji': costume})
-            await asyncio.sleep(0.2)
+            updates.append((bot['id'], {'emoji': costume}))
+
+        result = client.bulk(bulk.update_bots, updates)
+        print(result.summary())
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -0,0 +1,174 @@
+"""Run several bot apps in one process, sharing one websocket subscription.
+
+    python host.py rocket quantum halloween
+
+Each frame is decoded once and applied to one shared World. Every app then
+gets the entity through its own queue and dispatcher, so a slow app falls
+behind on its own rather than holding up the others, and an exception in one
+app is printed without affecting the rest. Apps also share one Runtime, so
+their PATCHes draw on the same rate limit.
+"""
+
+import time
+import asyncio
+import argparse
+import traceback
+
+import arctogether
+import bulk
+from bot import Runtime, roster_from_env
+from metrics import metrics
+from pipeline import EntityQueue, run_pipeline
+from recorder import recorder_from_env
+from world import World
+from worldstore import store_from_env
+
+
+class HostedApp:
+    def __init__(self, name, handle_entity, stats=None):
+        self.name = name
+        self.handle_entity = handle_entity
+        self.app_stats = stats
+        self.events = EntityQueue()
+        self.task = None
+
+        self.handled = 0
+        self.errors = 0
+        self.elapsed = 0
+        self.cpu = 0
+
+    async def handle(self, entity):
+        start = time.perf_counter()
+        # Process CPU time, so it includes anything else that ran while this
+        # handler was waiting. It's still a good guide to which app is busy.
+        cpu_start = time.process_time()
+        try:
+            await self.handle_entity(entity)
+        except Exception:
+            self.errors += 1
+            print(f"Error in app {self.name}:")
+            traceback.print_exc()
+        finally:
+            elapsed = time.perf_counter() - start
+            self.handled += 1
+            self.elapsed += elapsed
+            self.cpu += time.process_time() - cpu_start
+            metrics.observe("app", elapsed, app=self.name)
+
+    def stats(self):
+        stats = {
+            "handled": self.handled,
+            "errors": self.errors,
+            "elapsed": self.elapsed,
+            "cpu": self.cpu,
+            "events": self.events.metrics(),
+        }
+        if self.app_stats:
+            stats["app"] = self.app_stats()
+        return stats
+
+
+class AppHost:
+    def __init__(self, runtime, world=None, recorder=None, roster=None, subscription=None):
+        self.runtime = runtime
+        self.world = world if world is not None else World()
+        self.recorder = recorder
+        # Where entities come from: the RC websocket unless told otherwise,
+        # e.g. a broker.BrokerConnection.
+        self.subscription = subscription
+        # Bots from a previous run, for apps to take over as they start.
+        self.roster = roster
+        self.apps = {}
+
+    async def add(self, name, setup=None):
+        """Set up an app by name from APPS, or with setup(host)."""
+        handle_entity, stats = await (setup or APPS[name])(self)
+        self.apps[name] = HostedApp(name, handle_entity, stats)
+
+    async def handle_entity(self, entity):
+        entity = self.world.update(entity)
+        for app in self.apps.values():
+            app.events.put(entity)
+
+    async def run(self):
+        for app in self.apps.values():
+            app.task = asyncio.create_task(app.events.dispatch(app.handle))
+        try:
+            subscription = self.subscription or arctogether.Subscription(self.recorder)
+            await run_pipeline(subscription, self.handle_entity)
+        finally:
+            for app in self.apps.values():
+                app.task.cancel()
+
+    def stats(self):
+        return {name: app.stats() for name, app in self.apps.items()}
+
+
+async def rocket_app(host):
+    import rocket
+
+    launch_system = await rocket.ClankyBotLaunchSystem.create(
+        host.runtime, host.world, roster=host.roster
+    )
+    # The host has already applied the entity to the shared world.
+    return launch_system.triggers.dispatch, launch_system.launch_stats
+
+
+async def quantum_app(host):
+    import quantum
+
+    lab = quantum.RealityLab()
+    await lab.setup(host.runtime.api, roster=host.roster, runtime=host.runtime, world=host.world)
+    return lab.rc.handle_entity, None
+
+
+async def halloween_app(host):
+    import halloween
+
+    costumer = await halloween.Costumer.create(host.runtime, roster=host.roster)
+    return costumer.handle_entity, None
+
+
+APPS = {"rocket": rocket_app, "quantum": quantum_app, "halloween": halloween_app}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run bot apps on one websocket.")
+    parser.add_argument("apps", nargs="+", choices=APPS)
+    args = parser.parse_args()
+
+    async with arctogether.Client() as client:
+        runtime = Runtime(client)
+        roster = await roster_from_env(client)
+        host = AppHost(runtime, recorder=recorder_from_env(), roster=roster)
+        store = store_from_env()
+        saver = None
+        try:
+            if roster is None:
+                await bulk.delete_all(client)
+            if store:
+                store.load(host.world)
+                saver = asyncio.create_task(store.run(host.world))
+
+            for name in args.apps:
+                await host.add(name)
+            if roster is not None:
+                await roster.release(client)
+
+            await host.run()
+        finally:
+            print("Exitting... cleaning up.")
+            print("App stats: ", host.stats())
+            if host.recorder:
+                host.recorder.close()
+            if saver:
+                saver.cancel()
+            if store:
+                store.close(host.world)
+            await runtime.close()
+            if roster is None:
+                await bulk.delete_all(client)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
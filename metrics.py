@@ -0,0 +1,180 @@
+"""Timing histograms for each stage between a websocket frame and an applied PATCH.
+
+Stages ("spans") are:
+
+    parse      JSON decoding of a websocket frame
+    decode     building entity records from a message, and diffing snapshots
+    queue      an entity waiting in the event pipeline before being handled
+    app        one app handling an entity, labelled by app
+    handler    an entity handler or trigger running, labelled by handler
+    mailbox    a bot's update waiting for its PATCH to start
+    ratelimit  waiting for the rate limiter and circuit breaker
+    http       the REST round trip, labelled by endpoint
+    echo       from sending a PATCH to the websocket showing the new position
+
+A summary with p50/p95/p99 per span is printed every REPORT_INTERVAL seconds
+while a bot runs. Set RC_METRICS_PORT to also serve everything, per endpoint
+and per handler, in the Prometheus text format at /metrics.
+
+Labels must come from a small fixed set, such as endpoints or app names, and
+never from bot or entity ids: every label set keeps its own histogram for the
+life of the process.
+"""
+
+import os
+import math
+import asyncio
+import collections
+
+from aiohttp import web
+
+# Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+# Recent samples kept per histogram for working out percentiles.
+RECENT_SAMPLES = 1000
+# Seconds between printed summaries.
+REPORT_INTERVAL = 60
+
+METRICS_PORT = os.environ.get("RC_METRICS_PORT")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "recent")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+        self.recent = collections.deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds):
+        self.counts[bucket_index(seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.recent.append(seconds)
+
+
+def bucket_index(seconds):
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(BUCKETS)
+
+
+class Metrics:
+    def __init__(self):
+        # Histograms by span and then by sorted (label, value) pairs.
+        self.spans = {}
+        self.gauges = {}
+
+    def observe(self, span, seconds, **labels):
+        key = tuple(sorted((name, str(value)) for name, value in labels.items()))
+        histograms = self.spans.setdefault(span, {})
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(seconds)
+
+    def gauge(self, name, read, help_text=""):
+        """Report read() as a gauge."""
+        self.gauges[name] = (read, help_text)
+
+    def summary(self):
+        """Count and percentiles for each span, over all labels."""
+        summary = {}
+        for span, histograms in self.spans.items():
+            recent = [sample for histogram in histograms.values() for sample in histogram.recent]
+            summary[span] = {
+                "count": sum(histogram.count for histogram in histograms.values()),
+                "p50": percentile(recent, 50),
+                "p95": percentile(recent, 95),
+                "p99": percentile(recent, 99),
+            }
+        return summary
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        lines = [
+            "# HELP rc_span_seconds Time spent in each stage of handling an event.",
+            "# TYPE rc_span_seconds histogram",
+        ]
+        for span, histograms in sorted(self.spans.items()):
+            for key, histogram in sorted(histograms.items()):
+                labels = (("span", span),) + key
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (math.inf,), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    bucket_labels = format_labels(labels + (("le", le),))
+                    lines.append(f"rc_span_seconds_bucket{bucket_labels} {cumulative}")
+                lines.append(f"rc_span_seconds_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"rc_span_seconds_count{format_labels(labels)} {histogram.count}")
+        for name, (read, help_text) in sorted(self.gauges.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    async def report(self, interval=REPORT_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            for span, stats in self.summary().items():
+                print(
+                    f"Span {span}: n={stats['count']} p50={stats['p50']:.4f}s "
+                    f"p95={stats['p95']:.4f}s p99={stats['p99']:.4f}s"
+                )
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def serve(self, port, host="0.0.0.0"):
+        app = web.Application()
+        app.add_routes([web.get("/metrics", self.handle_metrics)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+        return runner
+
+
+def format_labels(labels):
+    def escape(value):
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+# Process-wide metrics, shared by every part of the bot.
+metrics = Metrics()
+
+
+async def run_reporting(metrics=metrics):
+    """Print summaries, and serve /metrics if RC_METRICS_PORT is set, until cancelled."""
+    runner = await metrics.serve(int(METRICS_PORT)) if METRICS_PORT else None
+    try:
+        await metrics.report()
+    finally:
+        if runner:
+            await runner.cleanup()
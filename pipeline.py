@@ -0,0 +1,114 @@
+import time
+import asyncio
+import traceback
+
+from metrics import metrics, run_reporting
+
+# Most distinct entities waiting to be handled before the oldest is dropped.
+# This needs to comfortably hold a full world snapshot.
+MAX_PENDING = 10000
+
+# Seconds between printing pipeline metrics.
+METRICS_INTERVAL = 60
+
+
+class EntityQueue:
+    """Entity updates waiting to be handled, keeping only the newest per id.
+
+    The websocket reader puts updates in without ever waiting, and a separate
+    dispatcher takes them out, so a slow handler can't hold up reading frames
+    or answering pings. An entity that moves again before it is handled keeps
+    its place in the queue but is handled with its latest state."""
+
+    def __init__(self, maxsize=MAX_PENDING):
+        self.maxsize = maxsize
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.closed = False
+
+        self.received = 0
+        self.handled = 0
+        self.superseded = 0
+        self.overflowed = 0
+        self.lag = 0
+        self.max_lag = 0
+
+    def put(self, entity, entity_id=None):
+        """Queue entity, or anything else standing for the entity with entity_id."""
+        self.received += 1
+        if entity_id is None:
+            entity_id = entity["id"]
+        if entity_id in self.pending:
+            self.superseded += 1
+            self.pending[entity_id] = (entity, self.pending[entity_id][1])
+        else:
+            if len(self.pending) >= self.maxsize:
+                del self.pending[next(iter(self.pending))]
+                self.overflowed += 1
+            self.pending[entity_id] = (entity, time.perf_counter())
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def get(self):
+        """Take the longest waiting entity, or None once closed and drained."""
+        while not self.pending:
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+
+        entity, received_at = self.pending.pop(next(iter(self.pending)))
+        self.lag = time.perf_counter() - received_at
+        metrics.observe("queue", self.lag)
+        self.max_lag = max(self.max_lag, self.lag)
+        return entity
+
+    async def fill(self, entities):
+        try:
+            async for entity in entities:
+                self.put(entity)
+        finally:
+            self.close()
+
+    async def dispatch(self, handle_entity):
+        while (entity := await self.get()) is not None:
+            try:
+                await handle_entity(entity)
+            except Exception:
+                traceback.print_exc()
+            self.handled += 1
+
+    def metrics(self):
+        return {
+            "depth": len(self.pending),
+            "received": self.received,
+            "handled": self.handled,
+            "superseded": self.superseded,
+            "overflowed": self.overflowed,
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+        }
+
+    async def report(self, interval=METRICS_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            print("Event pipeline: ", self.metrics())
+
+
+async def run_pipeline(entities, handle_entity, events=None):
+    """Read entities from an async iterator and handle them in a separate task."""
+    if events is None:
+        events = EntityQueue()
+    reader = asyncio.create_task(events.fill(entities))
+    reporter = asyncio.create_task(events.report())
+    span_reporter = asyncio.create_task(run_reporting())
+    try:
+        await events.dispatch(handle_entity)
+        await reader
+    finally:
+        reader.cancel()
+        reporter.cancel()
+        span_reporter.cancel()
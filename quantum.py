@@ -2,6 +2,11 @@ import random
 import asyncio
 import arctogether
 
+from bot import roster_from_env
+from recorder import recorder_from_env
+from triggers import LEAVE, Triggers
+
+INITIATE = {"x": 158, "y": 3}
 TARGET = {"x": 160, "y": 3}
 PARTICLE_HOME = {"x": 160, "y": 10}
 PARTICLE_AWAY = {"x": 160, "y": 28}
@@ -13,17 +18,31 @@ class RealityLab:
         self.rc = None
         self.target_id = None
 
+        self.triggers = Triggers()
+        self.triggers.on_tile(INITIATE, self.handle_initiate)
+        self.triggers.on_tile(TARGET, self.handle_target_acquired)
+        self.triggers.on_tile(TARGET, self.handle_target_gone, event=LEAVE)
+
     async def handle_entity(self, entity):
-        if entity["pos"] == {"x": 158, "y": 3} and entity.get("person_name") == "Adam Kelly":
+        await self.triggers.dispatch(entity)
+
+    def wants(self, data):
+        """Only people and our own bots can set anything off."""
+        return data.get("type") == "Avatar" or data["id"] in self.rc.bots
+
+    async def handle_initiate(self, entity):
+        if entity.get("person_name") == "Adam Kelly":
             print("Initialise sequence!")
             asyncio.create_task(self.run_sequence())
 
-        if entity["pos"] == TARGET:
-            print("TARGET ACQUIRED: ", entity)
-            if self.particle:
-                await self.particle.update(TARGET)
-                self.target_id = entity["id"]
-        elif entity["id"] == self.target_id and entity["pos"] != TARGET:
+    async def handle_target_acquired(self, entity):
+        print("TARGET ACQUIRED: ", entity)
+        if self.particle:
+            await self.particle.update(TARGET)
+            self.target_id = entity["id"]
+
+    async def handle_target_gone(self, entity):
+        if entity["id"] == self.target_id:
             print("Target gone - reset.")
             await self.particle.update(PARTICLE_HOME)
             self.target_id = None
@@ -49,18 +68,43 @@ class RealityLab:
             handle_update=None,
         )
         await asyncio.sleep(random.random() * 2)
-        await arctogether.update_bot(bot.id, {"emoji": random.choice("⚡🔥💥")})
+        await bot.update({"emoji": random.choice("⚡🔥💥")})
         await asyncio.sleep(random.random() * 2)
-        await arctogether.update_bot(bot.id, {"emoji": "🐞"})
+        await bot.update({"emoji": "🐞"})
 
     async def run_sequence(self):
         locations = [{"x": random.randint(152, 169), "y": random.randint(8, 27)} for _ in range(20)]
         asyncio.gather(*[self.break_reality(pos) for pos in locations])
 
     async def start(self):
-        await arctogether.clean_up_bots()
-
-        self.rc = arctogether.RcTogether(callbacks=[self.handle_entity])
+        async with arctogether.Client() as client:
+            await self.run(client)
+
+    async def run(self, client):
+        roster = await roster_from_env(client)
+        if roster is None:
+            await arctogether.clean_up_bots(client)
+        recorder = recorder_from_env()
+        try:
+            await self.setup(client, recorder, roster)
+            if roster is not None:
+                # Anything else is left over from a reality breaking sequence.
+                await roster.release(client)
+            await self.rc.run_websocket()
+        finally:
+            if recorder:
+                recorder.close()
+
+    async def setup(self, client, recorder=None, roster=None, runtime=None, world=None):
+        self.rc = arctogether.RcTogether(
+            callbacks=[self.handle_entity],
+            client=client,
+            recorder=recorder,
+            runtime=runtime,
+            world=world,
+            name="quantum",
+            wants=self.wants,
+        )
 
         self.particle = await self.rc.create_bot(
             name="Particle",
@@ -68,10 +112,9 @@ class RealityLab:
             x=PARTICLE_HOME["x"],
             y=PARTICLE_HOME["y"],
             handle_update=self.handle_particle_move,
+            roster=roster,
         )
 
-        await self.rc.run_websocket()
-
 
 if __name__ == "__main__":
     asyncio.run(RealityLab().start())
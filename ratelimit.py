@@ -0,0 +1,316 @@
+import os
+import time
+import random
+import asyncio
+
+import aiohttp
+
+from metrics import metrics
+
+# Process-wide budget shared by every bot, in requests per second, and how many
+# requests may go out back to back before that budget kicks in.
+GLOBAL_RATE = float(os.environ.get("RC_RATE_LIMIT", 10))
+GLOBAL_BURST = int(os.environ.get("RC_RATE_BURST", 10))
+
+# The budget adapts to how the server copes, AIMD style: while requests are
+# succeeding quickly it grows by RATE_INCREASE every INCREASE_INTERVAL seconds,
+# up to MAX_RATE. A 429 halves it, and 5xx responses, network errors or
+# responses slower than LATENCY_TARGET cut it by a smaller factor. It never
+# drops below MIN_RATE. Set RC_RATE_MAX to RC_RATE_LIMIT for a fixed budget.
+MIN_RATE = 1
+MAX_RATE = float(os.environ.get("RC_RATE_MAX", 50))
+RATE_INCREASE = 2
+INCREASE_INTERVAL = 2
+THROTTLED_BACKOFF = 0.5
+ERROR_BACKOFF = 0.75
+LATENCY_BACKOFF = 0.9
+LATENCY_TARGET = 1.0
+
+# We want to avoid sending successive updates for the same bot too quickly to
+# avoid overloading the RC server. The first update always goes straight out.
+MIN_INTERVAL = float(os.environ.get("RC_BOT_MIN_INTERVAL", 0.5))
+
+# How long to back off after a 429 that doesn't come with a Retry-After header.
+DEFAULT_RETRY_AFTER = 5
+
+# Bounds, in seconds, for the backoff between retries of a failed request.
+RETRY_MIN_DELAY = 0.5
+RETRY_MAX_DELAY = 10
+
+# After this many failures in a row from one endpoint, stop sending it requests
+# for BREAKER_RESET_TIME seconds, then let a single request through to see if
+# it has recovered. The wait doubles each time that request fails, up to
+# BREAKER_MAX_RESET_TIME.
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIME = 5
+BREAKER_MAX_RESET_TIME = 60
+
+
+def now():
+    return asyncio.get_running_loop().time()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def refill(self, at):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (at - self.updated) * self.rate)
+        self.updated = at
+
+    def reserve(self, at):
+        """Take a token and return how long the caller must wait before using it.
+
+        The balance may go negative, so concurrent callers queue up behind each
+        other instead of all waking at once when a token becomes available."""
+        self.refill(at)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def drain(self, at):
+        self.refill(at)
+        self.tokens = min(self.tokens, 0)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name,
+        threshold=BREAKER_THRESHOLD,
+        reset_time=BREAKER_RESET_TIME,
+        max_reset_time=BREAKER_MAX_RESET_TIME,
+    ):
+        self.name = name
+        self.threshold = threshold
+        self.min_reset_time = reset_time
+        self.max_reset_time = max_reset_time
+        self.reset_time = reset_time
+        self.failures = 0
+        # None while closed, otherwise when to let a trial request through.
+        self.open_until = None
+        self.probing = False
+        self.changed = asyncio.Event()
+        self.opened = 0
+
+    async def wait(self):
+        """Wait until a request may be sent to this endpoint. Returns True if
+        the request is the trial that decides whether to close the breaker."""
+        while self.open_until is not None:
+            delay = self.open_until - now()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif not self.probing:
+                self.probing = True
+                return True
+            else:
+                await self.changed.wait()
+        return False
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def record(self, ok, probe=False):
+        """Note how a request went: True, False for a transient failure, or None
+        if it never finished. While open, only the trial request's result counts;
+        requests sent before the breaker opened can still come back late."""
+        if self.open_until is not None and not probe:
+            return
+        if probe:
+            self.probing = False
+        if ok:
+            if self.open_until is not None:
+                print(f"Circuit closed: {self.name}")
+            self.failures = 0
+            self.open_until = None
+            self.reset_time = self.min_reset_time
+        elif ok is False:
+            self.failures += 1
+            if probe:
+                self.reset_time = min(self.max_reset_time, self.reset_time * 2)
+            if probe or (self.open_until is None and self.failures >= self.threshold):
+                self.opened += 1
+                self.open_until = now() + self.reset_time
+                print(f"Circuit open: {self.name}, retrying in {self.reset_time}s")
+        self.notify()
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        rate=GLOBAL_RATE,
+        burst=GLOBAL_BURST,
+        min_interval=MIN_INTERVAL,
+        min_rate=MIN_RATE,
+        max_rate=MAX_RATE,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        # Runtime spaces out each bot's updates by this much.
+        self.min_interval = min_interval
+        self.paused_until = 0
+
+        self.min_rate = min(min_rate, rate)
+        self.max_rate = max(max_rate, rate)
+        # Smoothed response time, and when the rate was last changed.
+        self.latency = None
+        self.adjusted_at = None
+        self.decreased_at = None
+        self.successes = 0
+        self.errors = 0
+        self.throttles = 0
+        self.breakers = {}
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    async def acquire(self):
+        """Wait out any pause, then until the global budget allows a request."""
+        while (delay := self.paused_until - now()) > 0:
+            await asyncio.sleep(delay)
+
+        delay = self.bucket.reserve(now())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def breaker(self, endpoint):
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(endpoint)
+        return self.breakers[endpoint]
+
+    async def request(self, call, endpoint=None, **labels):
+        """Await call() within the budget, and adjust the budget by how it went.
+
+        If endpoint is given, the request waits while that endpoint's circuit
+        breaker is open. Time spent waiting and in call() is recorded in the
+        ratelimit and http spans, with any labels given."""
+        waiting = time.perf_counter()
+        if endpoint:
+            labels["endpoint"] = endpoint
+        breaker = self.breaker(endpoint) if endpoint else None
+        probe = await breaker.wait() if breaker else False
+        ok = None
+        try:
+            await self.acquire()
+            start = now()
+            sent = time.perf_counter()
+            metrics.observe("ratelimit", sent - waiting, **labels)
+            try:
+                result = await call()
+            except Exception as exc:
+                ok = not transient(exc)
+                self.report_error(exc)
+                raise
+            finally:
+                metrics.observe("http", time.perf_counter() - sent, **labels)
+            ok = True
+            self.report_success(now() - start)
+            return result
+        finally:
+            if breaker:
+                breaker.record(ok, probe)
+
+    def set_rate(self, rate, reason):
+        at = now()
+        rate = min(self.max_rate, max(self.min_rate, rate))
+        self.adjusted_at = at
+        self.successes = 0
+        if rate != self.bucket.rate:
+            self.bucket.refill(at)
+            self.bucket.rate = rate
+            print(f"Request rate now {rate:.1f}/s ({reason})")
+
+    def decrease(self, factor, reason):
+        # Requests already in flight, or sent before a pause ends, report the
+        # same trouble, so only cut the rate once per round trip or pause.
+        at = now()
+        if self.decreased_at is not None:
+            if at < max(self.decreased_at + (self.latency or 1), self.paused_until):
+                return
+        self.decreased_at = at
+        self.set_rate(self.bucket.rate * factor, reason)
+
+    def report_success(self, latency):
+        at = now()
+        self.successes += 1
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.adjusted_at is None:
+            self.adjusted_at = at
+        elif (elapsed := at - self.adjusted_at) >= INCREASE_INTERVAL:
+            if self.latency > LATENCY_TARGET:
+                self.decrease(LATENCY_BACKOFF, f"slow responses, {self.latency:.2f}s")
+            elif self.successes < self.bucket.rate * elapsed / 2:
+                # We aren't using the budget we have, so this tells us nothing
+                # about whether the server could take more.
+                self.adjusted_at = at
+                self.successes = 0
+            else:
+                self.set_rate(self.bucket.rate + RATE_INCREASE, f"{self.successes} ok")
+
+    def throttled(self, retry_after=DEFAULT_RETRY_AFTER):
+        at = now()
+        self.throttles += 1
+        print(f"Rate limited by server, pausing for {retry_after}s")
+        self.decrease(THROTTLED_BACKOFF, "429")
+        self.paused_until = max(self.paused_until, at + retry_after)
+        self.bucket.drain(at)
+
+    def report_error(self, exc):
+        """Back off if exc means the server is struggling: a 429, a 5xx or a network error."""
+        delay = retry_after(exc)
+        if delay is not None:
+            self.throttled(delay)
+        elif transient(exc):
+            self.errors += 1
+            self.decrease(ERROR_BACKOFF, repr(exc))
+
+    def stats(self):
+        return {
+            "rate": self.bucket.rate,
+            "latency": self.latency,
+            "errors": self.errors,
+            "throttles": self.throttles,
+            "circuits_opened": {
+                endpoint: breaker.opened for endpoint, breaker in self.breakers.items()
+            },
+        }
+
+
+def status_of(exc):
+    """The HTTP status of an HttpError from rctogether or arctogether, else None."""
+    if exc.args and isinstance(exc.args[0], int):
+        return exc.args[0]
+    return None
+
+
+def transient(exc):
+    """Whether exc is a failure that might go away if we try again later."""
+    status = status_of(exc)
+    if status is None:
+        return isinstance(exc, (OSError, asyncio.TimeoutError, aiohttp.ClientError))
+    return status == 429 or status >= 500
+
+
+def backoff(tries, low=RETRY_MIN_DELAY, high=RETRY_MAX_DELAY):
+    """A random delay before retry number tries, from a doubling range."""
+    return random.uniform(0, min(high, low * 2 ** (tries - 1)))
+
+
+def retry_after(exc):
+    """Seconds to back off for a 429 HttpError, or None for any other error."""
+    if status_of(exc) != 429:
+        return None
+    try:
+        return float(getattr(exc, "retry_after", None))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+limiter = RateLimiter()
+metrics.gauge("rc_request_rate", lambda: limiter.rate, "Current global request budget per second.")
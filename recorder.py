@@ -0,0 +1,43 @@
+"""Record websocket traffic to replay later with replay.py.
+
+    RC_RECORD=capture.jsonl.gz python quantum.py
+
+Each line of the capture is a frame as received, with the seconds since
+recording started.
+"""
+
+import os
+import gzip
+import json
+import time
+
+# Seconds between flushes of the capture file, so that little is lost if the
+# bot is killed rather than shut down cleanly.
+FLUSH_INTERVAL = 1
+
+
+class Recorder:
+    def __init__(self, path):
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.start = time.monotonic()
+        self.flushed = self.start
+
+    def record(self, frame):
+        if isinstance(frame, bytes):
+            frame = frame.decode("utf-8")
+        at = time.monotonic()
+        self.file.write(json.dumps({"t": round(at - self.start, 6), "frame": frame}) + "\n")
+        if at - self.flushed > FLUSH_INTERVAL:
+            self.file.flush()
+            self.flushed = at
+
+    def close(self):
+        self.file.close()
+
+
+def recorder_from_env():
+    path = os.environ.get("RC_RECORD")
+    if path:
+        print("Recording websocket frames to: ", path)
+        return Recorder(path)
+    return None
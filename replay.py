@@ -0,0 +1,164 @@
+"""Replay recorded websocket traffic into bot handlers.
+
+Record a live session by setting RC_RECORD when running a bot (see recorder.py):
+
+    RC_RECORD=capture.jsonl.gz python quantum.py
+
+then replay it against an offline backend, at recorded speed, 100x, or as fast
+as possible:
+
+    python replay.py capture.jsonl.gz --app rocket --speed 100
+    python replay.py capture.jsonl.gz --app quantum --speed max
+
+or at recorded speed on a virtual clock, so that rocket dwell times, rate
+limits and other waits take no real time, and runs with the same --seed repeat
+exactly:
+
+    python replay.py capture.jsonl.gz --app rocket --virtual --seed 1
+
+Compare rocket targeting strategies on the same capture with ROCKET_PREDICT=0.
+"""
+
+import gzip
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import virtualtime
+from bot import Runtime
+from decode import is_ping, loads, message_entities
+from fakeserver import InMemoryApi
+from metrics import percentile
+from ratelimit import limiter, now
+
+
+def read_frames(path):
+    line = None
+    with gzip.open(path, "rt", encoding="utf-8") as capture:
+        try:
+            for line in capture:
+                record = json.loads(line)
+                yield record["t"], record["frame"]
+        except (EOFError, json.JSONDecodeError):
+            # The recording bot was killed mid-write. Keep what we have.
+            print("Capture truncated after frame: ", line)
+
+
+def frame_entities(frame):
+    if is_ping(frame):
+        return []
+    data = loads(frame)
+    message = data.get("message")
+    if isinstance(message, dict) and "payload" in message:
+        return message_entities(message)
+    return []
+
+
+async def replay(path, handle_entity, speed=1.0):
+    """Feed every entity in a capture to handle_entity and time each call.
+
+    Frames are spaced out by their recorded timestamps divided by speed, or
+    sent back to back if speed is 0."""
+    frames = 0
+    latencies = []
+    start = time.perf_counter()
+    # Paced by the event loop's clock, which may be virtual.
+    clock_start = now()
+
+    for t, frame in read_frames(path):
+        delay = clock_start + t / speed - now() if speed else 0
+        # Always yield, so that bot updates get sent even at full speed.
+        await asyncio.sleep(max(delay, 0))
+
+        frames += 1
+        for entity in frame_entities(frame):
+            began = time.perf_counter()
+            await handle_entity(entity)
+            latencies.append(time.perf_counter() - began)
+
+    elapsed = time.perf_counter() - start
+    return {
+        "frames": frames,
+        "events": len(latencies),
+        "elapsed": elapsed,
+        "clock_elapsed": now() - clock_start,
+        "events_per_sec": len(latencies) / elapsed if elapsed else None,
+        "handler_p50": percentile(latencies, 50),
+        "handler_p95": percentile(latencies, 95),
+        "handler_p99": percentile(latencies, 99),
+        "handler_max": max(latencies, default=None),
+    }
+
+
+async def rocket_app(api, limiter=limiter):
+    import rocket
+
+    launch_system = await rocket.ClankyBotLaunchSystem.create(Runtime(api, limiter=limiter))
+    return launch_system.handle_entity, launch_system.launch_stats
+
+
+async def quantum_app(api, limiter=limiter):
+    import quantum
+
+    lab = quantum.RealityLab()
+    await lab.setup(api, runtime=Runtime(api, limiter=limiter))
+    return lab.rc.handle_entity, None
+
+
+# Each app sets itself up against the given backend and rate limiter, and
+# returns its entity handler, along with a function for any stats of its own
+# worth reporting.
+APPS = {"rocket": rocket_app, "quantum": quantum_app}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a websocket capture into a bot app.")
+    parser.add_argument("capture")
+    parser.add_argument("--app", choices=APPS, default="rocket")
+    parser.add_argument("--speed", default="1", help="speed up factor, or 'max'")
+    parser.add_argument("--virtual", action="store_true", help="run on a virtual clock")
+    parser.add_argument("--seed", type=int, help="seed the apps' random choices")
+    parser.add_argument(
+        "--settle", type=float, default=0, help="seconds to keep running after the last frame"
+    )
+    return parser.parse_args()
+
+
+async def run_replay(args):
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    echoes = asyncio.Queue()
+    api = InMemoryApi(echo=echoes.put_nowait)
+    handle_entity, app_stats = await APPS[args.app](api)
+
+    async def pump_echoes():
+        while True:
+            await handle_entity(await echoes.get())
+
+    pump = asyncio.create_task(pump_echoes())
+    stats = await replay(
+        args.capture, handle_entity, 0 if args.speed == "max" else float(args.speed)
+    )
+    # Give launches and clean up in progress a chance to finish.
+    await asyncio.sleep(args.settle)
+    pump.cancel()
+
+    stats["api_calls"] = api.stats
+    if app_stats:
+        stats["app"] = app_stats()
+    print(json.dumps(stats, indent=2))
+
+
+def main():
+    args = parse_args()
+    if args.virtual:
+        virtualtime.run(run_replay(args))
+    else:
+        asyncio.run(run_replay(args))
+
+
+if __name__ == "__main__":
+    main()
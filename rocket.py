@@ -1,11 +1,23 @@
+import os
+import re
+import math
 import logging
 import random
 import asyncio
+import functools
+import collections
 
-import rctogether
+import arctogether
 
-# Currently we reimplement our own Bot class here.
-# from bot import Bot
+import bulk
+from bot import Bot, Runtime, roster_from_env
+from pipeline import run_pipeline
+from triggers import Triggers
+from world import World, normalise_name
+from worldstore import store_from_env
+from ratelimit import now
+from metrics import percentile
+from recorder import recorder_from_env
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,14 +28,71 @@ logging.basicConfig(level=logging.INFO)
 CONTROL_COMPUTER = {"x": 27, "y": 61}
 LAUNCH_PAD = {"x": 25, "y": 60}
 
-TARGETS = {}
+# Rockets kept parked on the launch pad, so that a launch never has to wait
+# for a new rocket to be created.
+ROCKET_POOL_SIZE = 3
+
 ROCKET_LOCATION = None
 
+# Rather than chasing a moving target's every step, rockets aim for where the
+# target is heading. Set ROCKET_PREDICT=0 to chase, e.g. to compare the two in
+# a replay.
+PREDICT_INTERCEPT = os.environ.get("ROCKET_PREDICT", "1") != "0"
+# Assumed rocket speed in tiles per second, used to work out how far ahead of
+# the target to aim.
+ROCKET_SPEED = 5
+# Seconds of target movement used to estimate its velocity.
+TRACKING_WINDOW = 2
+# Never aim further ahead than this many seconds of target movement.
+MAX_LEAD_TIME = 5
+# Faster than anyone walks, in tiles per second. A target that seems to move
+# faster has jumped, e.g. to another person, so we start tracking them afresh.
+JUMP_SPEED = 20
+# Only send the rocket a new course once the predicted intercept has moved
+# more than this many tiles from where it's currently headed.
+REAIM_THRESHOLD = 2
+# Seconds to wait for a target to turn up, e.g. if their name was misspelt,
+# before giving their rocket back.
+TARGET_TIMEOUT = 300
+
+
+def xy(pos):
+    return (pos["x"], pos["y"])
+
+
+def predict_intercept(history, origin, speed=ROCKET_SPEED, max_lead=MAX_LEAD_TIME):
+    """Where a rocket at origin should head to meet a target moving as it has
+    been, given the target's recent (time, x, y) positions."""
+    t1, x1, y1 = history[-1]
+    t0, x0, y0 = history[0]
+    if t1 - t0 <= 0:
+        return {"x": x1, "y": y1}
+
+    vx = (x1 - x0) / (t1 - t0)
+    vy = (y1 - y0) / (t1 - t0)
+    # The time to reach the target depends on where we meet it, so refine a
+    # guess a few times. This converges quickly whenever the rocket is faster
+    # than the target.
+    lead = 0
+    for _ in range(3):
+        meet = (x1 + vx * lead, y1 + vy * lead)
+        lead = min(max_lead, math.dist(origin, meet) / speed)
+    # We don't know how big the space is, but it starts at 0, 0.
+    return {"x": max(0, round(x1 + vx * lead)), "y": max(0, round(y1 + vy * lead))}
+
+
+def wanted_entities(runtime):
+    """A Subscription prefilter for what rocket reacts to: people, notes on the
+    control computer and its own bots."""
+
+    def wants(data):
+        return (
+            data.get("type") == "Avatar"
+            or data.get("pos") == CONTROL_COMPUTER
+            or data["id"] in runtime.bots
+        )
 
-def normalise_name(name):
-    if name is None:
-        return None
-    return name.strip("\n\r\t \u200b")
+    return wants
 
 
 def first_name(s):
@@ -58,203 +127,447 @@ PAYLOADS = {
 }
 
 
-class Bot:
-    def __init__(self, bot_json):
-        self.bot_json = bot_json
-        self.queue = asyncio.Queue()
-        self.task = None
-
-    @classmethod
-    async def create(cls, session, name, emoji, x, y):
-        bot_json = await rctogether.bots.create(
-            session, name=name, emoji=emoji, x=x, y=y
-        )
-        bot = cls(bot_json)
-        bot.task = asyncio.create_task(bot.run(session))
-        return bot
-
-    @property
-    def pos(self):
-        return self.bot_json["pos"]
+def debris_pattern(template):
+    """A regex matching any message made from template."""
+    parts = re.split(r"%\((?:victim|instigator)\)s", template)
+    return re.compile(".*".join(re.escape(part) for part in parts))
 
-    @property
-    def id(self):
-        return self.bot_json["id"]
 
-    async def run(self, session):
-        while True:
-            update = await self.queue.get()
+DEBRIS_PATTERNS = {emoji: debris_pattern(template) for emoji, template in PAYLOADS.items()}
 
-            while update is not None and not self.queue.empty():
-                print("Skipping outdated update: ", update)
-                update = await self.queue.get()
 
-            print("Applying update: ", update)
-            await rctogether.bots.update(session, self.id, update)
-            await asyncio.sleep(1)
+def is_debris(bot_json):
+    """Whether a bot from a previous run is one of our wrecks, rather than
+    another app's bot that happens to share an emoji with a payload."""
+    pattern = DEBRIS_PATTERNS.get(bot_json["emoji"])
+    return pattern is not None and pattern.fullmatch(bot_json["name"]) is not None
 
-    async def update(self, update):
-        await self.queue.put(update)
 
-    async def destroy(self, session):
-        await rctogether.bots.delete(session, self.id)
+class Launch:
+    __slots__ = (
+        "rocket",
+        "target",
+        "instigator",
+        "requested_at",
+        "launched_at",
+        "trigger",
+        "history",
+        "aim",
+        "expiry",
+    )
 
-    def update_data(self, data):
-        self.bot_json = data
+    def __init__(self, rocket, target, instigator, requested_at):
+        self.rocket = rocket
+        self.target = target
+        self.instigator = instigator
+        self.requested_at = requested_at
+        self.launched_at = None
+        self.trigger = None
+        # Recent (time, x, y) sightings of the target, and where the rocket
+        # was last sent.
+        self.history = collections.deque()
+        self.aim = None
+        # Gives up on the target if it isn't seen before launch.
+        self.expiry = None
+
+    def sighted(self, pos, at):
+        if self.history:
+            t0, x0, y0 = self.history[-1]
+            # A step at a time is never a jump, however close together the
+            # updates arrive.
+            if math.dist((x0, y0), xy(pos)) > max(1, JUMP_SPEED * (at - t0)):
+                self.history.clear()
+        self.history.append((at, pos["x"], pos["y"]))
+        while at - self.history[0][0] > TRACKING_WINDOW:
+            self.history.popleft()
 
 
 class ClankyBotLaunchSystem:
-    def __init__(self, session, rocket, gc_bot):
-        self.instigator = None
-        self.target = "Nobody"
-        self.session = session
-        self.rocket = rocket
+    def __init__(
+        self,
+        runtime,
+        gc_bot,
+        world,
+        pool_size=ROCKET_POOL_SIZE,
+        predict=PREDICT_INTERCEPT,
+        roster=None,
+    ):
+        self.runtime = runtime
         self.gc_bot = gc_bot
+        self.world = world
+        self.pool_size = pool_size
+        self.predict = predict
+        # Rockets from a previous run to reuse before creating new ones.
+        self.roster = roster
+
+        # Parked rockets ready to go, rockets in flight by id, and launch
+        # requests waiting for a rocket.
+        self.pool = collections.deque()
+        self.launches = {}
+        self.requests = collections.deque()
+        self.spawning = set()
+        self.rocket_triggers = {}
+        self.times_to_launch = collections.deque(maxlen=100)
+        self.times_to_hit = collections.deque(maxlen=100)
+        self.hits = 0
+        self.course_changes = 0
+
+        self.triggers = Triggers()
+        self.triggers.on_tile(CONTROL_COMPUTER, self.handle_instruction)
+        self.triggers.on_entity(gc_bot.id, gc_bot.handle_update)
 
     @classmethod
-    async def create(cls, session):
-        rocket = await Bot.create(
-            session, name="Rocket Bot", emoji="🚀", x=LAUNCH_PAD["x"], y=LAUNCH_PAD["y"]
+    async def create(
+        cls, runtime, world=None, pool_size=ROCKET_POOL_SIZE, predict=PREDICT_INTERCEPT, roster=None
+    ):
+        """Set up the launch system, taking over rockets, debris and the garbage
+        collector from roster if given."""
+        gc_bot = await GarbageCollectionBot.create(runtime, roster=roster)
+        launch_system = cls(
+            runtime, gc_bot, world if world is not None else World(), pool_size, predict, roster
         )
-        gc_bot = await GarbageCollectionBot.create(session)
+        if roster is not None:
+            for bot_json in roster.claim_all(is_debris):
+                await gc_bot.add_garbage(Bot.adopt(runtime, bot_json))
+        launch_system.refill_pool()
+        await asyncio.gather(*launch_system.spawning)
+
+        print("Rockets are : ", list(launch_system.pool))
+        return launch_system
 
-        print("Rocket is : ", rocket)
-        return cls(session, rocket, gc_bot)
+    @property
+    def rockets(self):
+        return list(self.pool) + [launch.rocket for launch in self.launches.values()]
 
-    async def respawn_rocket(self):
-        self.instigator = None
-        self.rocket = await Bot.create(
-            self.session,
+    async def spawn_rocket(self):
+        rocket = await Bot.create(
+            self.runtime,
             name="Rocket Bot",
             emoji="🚀",
             x=LAUNCH_PAD["x"],
             y=LAUNCH_PAD["y"],
+            roster=self.roster,
+        )
+        self.rocket_triggers[rocket.id] = self.triggers.on_entity(
+            rocket.id, functools.partial(self.handle_rocket_move, rocket)
+        )
+        self.pool.append(rocket)
+        await self.start_launches()
+
+    def refill_pool(self):
+        # Count rockets still being created, so we don't order replacements
+        # twice over.
+        for _ in range(self.pool_size - len(self.pool) - len(self.spawning)):
+            task = asyncio.create_task(self.spawn_rocket())
+            self.spawning.add(task)
+            task.add_done_callback(self.spawning.discard)
+
+    async def start_launches(self):
+        while self.requests and self.pool:
+            target, instigator, requested_at = self.requests.popleft()
+            rocket = self.pool.popleft()
+            launch = Launch(rocket, target, instigator, requested_at)
+            launch.trigger = self.triggers.on_person(
+                target, functools.partial(self.handle_target_detected, launch)
+            )
+            self.launches[rocket.id] = launch
+            launch.expiry = asyncio.create_task(self.expire(launch))
+
+            target_position = self.world.position_of(target)
+            if target_position:
+                await self.track(launch, target_position)
+        self.refill_pool()
+
+    def aim(self, launch):
+        if not self.predict:
+            return {"x": launch.history[-1][1], "y": launch.history[-1][2]}
+        return predict_intercept(launch.history, xy(launch.rocket.pos))
+
+    async def track(self, launch, target_position):
+        launch.sighted(target_position, now())
+        aim = self.aim(launch)
+        threshold = REAIM_THRESHOLD if self.predict else 0
+        if launch.aim is None or math.dist(xy(aim), xy(launch.aim)) > threshold:
+            await self.fire(launch, aim)
+
+    async def fire(self, launch, aim):
+        launch.aim = aim
+        self.course_changes += 1
+        await launch.rocket.update(aim)
+        if launch.launched_at is None:
+            launch.launched_at = now()
+            launch.expiry.cancel()
+            launch.expiry = None
+            self.times_to_launch.append(launch.launched_at - launch.requested_at)
+            print(
+                f"Launched at {launch.target} after {launch.launched_at - launch.requested_at:.3f}s"
+            )
+
+    def finish(self, launch):
+        if launch.expiry:
+            launch.expiry.cancel()
+        self.triggers.remove(launch.trigger)
+        del self.launches[launch.rocket.id]
+
+    async def expire(self, launch):
+        await asyncio.sleep(TARGET_TIMEOUT)
+        print(f"Gave up waiting for {launch.target} to turn up")
+        launch.expiry = None
+        self.finish(launch)
+        await self.park(launch.rocket)
+        await self.start_launches()
+
+    async def park(self, rocket):
+        """Bring a rocket back to the pool, or get rid of it if the pool has
+        already been refilled without it."""
+        if len(self.pool) + len(self.spawning) < self.pool_size:
+            await rocket.update(LAUNCH_PAD)
+            self.pool.append(rocket)
+        else:
+            self.triggers.remove(self.rocket_triggers.pop(rocket.id))
+            await rocket.destroy()
+
+    async def hit(self, launch):
+        rocket = launch.rocket
+        self.finish(launch)
+        self.triggers.remove(self.rocket_triggers.pop(rocket.id))
+        self.hits += 1
+        if launch.launched_at is not None:
+            self.times_to_hit.append(now() - launch.launched_at)
+        emoji = random.choice(list(PAYLOADS))
+        await rocket.update(
+            {
+                "emoji": emoji,
+                "name": debris_message(emoji, launch.target, launch.instigator),
+            }
         )
-        self.target = "Nobody"
+        await self.gc_bot.add_garbage(rocket)
+        self.refill_pool()
+
+    def launch_stats(self):
+        return {
+            "launches": len(self.times_to_launch),
+            "in_flight": len(self.launches),
+            "queued": len(self.requests),
+            "parked": len(self.pool),
+            "time_to_launch_p50": percentile(self.times_to_launch, 50),
+            "time_to_launch_max": max(self.times_to_launch, default=None),
+            "hits": self.hits,
+            "course_changes": self.course_changes,
+            "hits_per_course_change": (
+                self.hits / self.course_changes if self.course_changes else None
+            ),
+            "time_to_hit_p50": percentile(self.times_to_hit, 50),
+            "time_to_hit_max": max(self.times_to_hit, default=None),
+        }
 
     async def handle_instruction(self, entity):
         print("New instructions received: ", entity)
         note_text = entity.get("note_text")
+        if note_text is None:
+            # Somebody standing on the control computer, rather than a note.
+            return
         if note_text == "":
-            self.instigator = None
-            self.target = "Nobody"
-            await self.rocket.update(LAUNCH_PAD)
+            self.requests.clear()
+            for launch in list(self.launches.values()):
+                self.finish(launch)
+                await self.park(launch.rocket)
         else:
-            self.instigator = entity.get("updated_by").get("name")
-            self.target = normalise_name(note_text)
-            if self.target in TARGETS:
-                await self.rocket.update(TARGETS[self.target])
+            instigator = entity.get("updated_by").get("name")
+            self.requests.append((normalise_name(note_text), instigator, now()))
+            await self.start_launches()
+
+    async def handle_rocket_move(self, rocket, entity):
+        rocket.update_data(entity)
+        launch = self.launches.get(rocket.id)
+        if launch is None:
+            return
 
-    async def handle_rocket_move(self, entity):
-        self.rocket.update_data(entity)
         rocket_position = entity["pos"]
-        target_position = TARGETS.get(self.target)
+        target_position = self.world.position_of(launch.target)
 
-        print("TARGET HIT: ", rocket_position, target_position)
         if rocket_position == target_position:
-            emoji = random.choice(list(PAYLOADS))
-            await self.rocket.update(
-                {
-                    "emoji": emoji,
-                    "name": debris_message(emoji, self.target, self.instigator),
-                }
-            )
-            await self.gc_bot.add_garbage(self.rocket)
-            await self.respawn_rocket()
-
-    async def handle_target_detected(self, entity):
+            print("TARGET HIT: ", rocket_position, target_position)
+            await self.hit(launch)
+        elif rocket_position == launch.aim and launch.history:
+            # Got where we were aiming, but the target didn't. Head for
+            # wherever it's going now.
+            aim = self.aim(launch)
+            if aim != rocket_position:
+                await self.fire(launch, aim)
+
+    async def handle_target_detected(self, launch, entity):
         target_position = entity["pos"]
         print("Target detected at: ", target_position)
-        await self.rocket.update(target_position)
+        if target_position == launch.rocket.pos and launch.launched_at is not None:
+            # The target walked into the rocket.
+            await self.hit(launch)
+        else:
+            await self.track(launch, target_position)
 
     async def handle_entity(self, entity):
-        person_name = normalise_name(entity.get("person_name"))
-        if person_name:
-            TARGETS[person_name] = entity["pos"]
+        self.world.update(entity)
+        await self.triggers.dispatch(entity)
 
-        if person_name == self.target:
-            await self.handle_target_detected(entity)
 
-        elif entity.get("pos") == CONTROL_COMPUTER:
-            await self.handle_instruction(entity)
+GARBAGE_COLLECTION_HOME = {"x": 22, "y": 61}
+MIN_GARBAGE_TO_COLLECT = 3
+# Seconds the crew spends at each wreck.
+COLLECTION_DWELL_TIME = 15
+# Give up waiting to reach a wreck after this long, in case an update was lost.
+ARRIVAL_TIMEOUT = 30
 
-        elif entity["id"] == self.rocket.id:
-            await self.handle_rocket_move(entity)
 
-        elif entity["id"] == self.gc_bot.id:
-            self.gc_bot.handle_update(entity)
+def route_length(points):
+    return sum(math.dist(a, b) for a, b in zip(points, points[1:]))
 
 
-GARBAGE_COLLECTION_HOME = {"x": 22, "y": 61}
-MIN_GARBAGE_TO_COLLECT = 3
+def plan_route(home, garbage):
+    """Order garbage into a short round trip from home.
+
+    Starts with nearest neighbour, then applies 2-opt (reversing a stretch of
+    the route) until no reversal makes the trip shorter."""
+    route = []
+    remaining = list(garbage)
+    here = xy(home)
+    while remaining:
+        nearest = min(remaining, key=lambda item: math.dist(here, xy(item.pos)))
+        remaining.remove(nearest)
+        route.append(nearest)
+        here = xy(nearest.pos)
+
+    def length(route):
+        return route_length([xy(home), *(xy(item.pos) for item in route), xy(home)])
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(route) - 1):
+            for j in range(i + 1, len(route)):
+                candidate = route[:i] + route[i : j + 1][::-1] + route[j + 1 :]
+                if length(candidate) < length(route) - 1e-9:
+                    route = candidate
+                    improved = True
+    return route
 
 
 class GarbageCollectionBot:
-    def __init__(self, session, garbage_bot):
-        self.session = session
+    def __init__(self, garbage_bot, dwell_time=COLLECTION_DWELL_TIME):
         self.garbage_bot = garbage_bot
-        self.garbage_queue = asyncio.Queue()
-        self.garbage = None
+        self.dwell_time = dwell_time
+        self.garbage = []
+        self.enough_garbage = asyncio.Event()
+        self.destination = None
+        self.arrived = asyncio.Event()
         self.task = None
 
     @classmethod
-    async def create(cls, session):
+    async def create(cls, runtime, dwell_time=COLLECTION_DWELL_TIME, roster=None):
         garbage_bot = await Bot.create(
-            session,
+            runtime,
             name="Garbage Collector",
             emoji="🛺",
             **GARBAGE_COLLECTION_HOME,
+            roster=roster,
         )
-        gc_bot = cls(session, garbage_bot)
+        gc_bot = cls(garbage_bot, dwell_time)
         gc_bot.task = asyncio.create_task(gc_bot.run())
         return gc_bot
 
     async def run(self):
         while True:
-            if self.garbage_queue.qsize() <= MIN_GARBAGE_TO_COLLECT:
-                await asyncio.sleep(60)
-            elif self.garbage:
-                print("Hey, we're already busy here.")
-                await asyncio.sleep(60)
-            else:
-                await self.collect(await self.garbage_queue.get())
+            await self.enough_garbage.wait()
+            self.enough_garbage.clear()
+            trip, self.garbage = self.garbage, []
+            await self.collect(trip)
 
     @property
     def id(self):
         return self.garbage_bot.id
 
     async def add_garbage(self, garbage):
-        await self.garbage_queue.put(garbage)
+        self.garbage.append(garbage)
+        if len(self.garbage) > MIN_GARBAGE_TO_COLLECT:
+            self.enough_garbage.set()
 
-    async def collect(self, garbage):
-        self.garbage = garbage
-        print("Crew dispatched to collect: ", self.garbage)
-        await self.garbage_bot.update(self.garbage.pos)
+    async def collect(self, trip):
+        route = plan_route(GARBAGE_COLLECTION_HOME, trip)
+        print("Crew dispatched to collect: ", route)
+        for garbage in route:
+            await self.drive_to(garbage.pos)
+            await asyncio.sleep(self.dwell_time)
 
-    async def complete_collection(self):
-        await asyncio.sleep(15)
         print("Ready to complete collection!")
-        await self.garbage.destroy(self.session)
-        self.garbage = None
+        runtime = self.garbage_bot.runtime
+        result = await bulk.delete_bots(
+            runtime.api, [garbage.id for garbage in trip], limiter=runtime.limiter
+        )
+        # Anything that still wouldn't go is picked up on the next trip.
+        failed = {bot_id for bot_id, _ in result.failures}
+        for garbage in trip:
+            if garbage.id in failed:
+                self.garbage.append(garbage)
+            else:
+                runtime.remove(garbage)
         await self.garbage_bot.update(GARBAGE_COLLECTION_HOME)
 
-    def handle_update(self, entity):
-        if self.garbage and entity["pos"] == self.garbage.pos:
-            print("Collection complete: ", entity, self.garbage)
-            asyncio.create_task(self.complete_collection())
+    async def drive_to(self, pos):
+        if self.garbage_bot.pos == pos:
+            return
+        self.destination = pos
+        self.arrived.clear()
+        await self.garbage_bot.update(pos)
+        try:
+            await asyncio.wait_for(self.arrived.wait(), ARRIVAL_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Crew never arrived at: ", pos)
+        self.destination = None
+
+    async def handle_update(self, entity):
+        self.garbage_bot.update_data(entity)
+        if self.destination and entity["pos"] == self.destination:
+            print("Crew arrived at: ", self.destination)
+            self.arrived.set()
 
 
 async def main():
-    async with rctogether.RestApiSession() as session:
+    async with arctogether.Client() as client:
+        runtime = Runtime(client)
+        recorder = recorder_from_env()
+        roster = await roster_from_env(runtime.api)
+        world = World()
+        store = store_from_env()
+        saver = None
+        launch_system = None
         try:
-            await rctogether.bots.delete_all(session)
-
-            launch_system = await ClankyBotLaunchSystem.create(session)
-            async for entity in rctogether.WebsocketSubscription():
-                await launch_system.handle_entity(entity)
+            if roster is None:
+                await bulk.delete_all(runtime.api)
+            if store:
+                # Know where people are before the websocket tells us.
+                store.load(world)
+                saver = asyncio.create_task(store.run(world))
+
+            launch_system = await ClankyBotLaunchSystem.create(runtime, world, roster=roster)
+            if roster is not None:
+                await roster.release(runtime.api)
+            subscription = arctogether.Subscription(recorder, wanted_entities(runtime))
+            await run_pipeline(subscription, launch_system.handle_entity)
         finally:
             print("Exitting... cleaning up.")
-            await rctogether.bots.delete_all(session)
+            if launch_system:
+                print("Trigger stats: ", launch_system.triggers.stats())
+                print("Launch stats: ", launch_system.launch_stats())
+            print("Rate limiter: ", runtime.limiter.stats())
+            if recorder:
+                recorder.close()
+            if saver:
+                saver.cancel()
+            if store:
+                store.close(world)
+            await runtime.close()
+            if roster is None:
+                # On a warm start, leave the bots for the next run to take over.
+                await bulk.delete_all(runtime.api)
 
 
 if __name__ == "__main__":
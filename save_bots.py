@@ -1,13 +1,12 @@
-import asyncio
 import json
-import rctogether
 
+from syncclient import SyncClient
 
-async def main():
-    async with rctogether.RestApiSession() as session:
-        bots = await rctogether.bots.get(session)
-        print(json.dumps(bots))
+
+def main():
+    with SyncClient() as client:
+        print(json.dumps(client.get_bots()))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
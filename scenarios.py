@@ -0,0 +1,102 @@
+"""Scripted end-to-end runs of the bot apps against an in-process backend.
+
+    python scenarios.py rocket
+    python scenarios.py quantum --seed 7
+
+Each scenario plays a few minutes of people moving around into an app, then
+lets it finish what it started: rockets hit and the garbage crew collects the
+debris, or reality breaks and mends. By default this runs on a virtual clock
+and takes a fraction of a second, with the same result every time for a given
+seed. Pass --real-time to watch it at the speed it would run live.
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import virtualtime
+from fakeserver import InMemoryApi
+from ratelimit import RateLimiter, now
+from replay import APPS
+
+# Seconds to keep running after the last scripted event.
+SETTLE_TIME = 180
+
+
+def avatar(entity_id, name, x, y):
+    return {"id": entity_id, "type": "Avatar", "person_name": name, "pos": {"x": x, "y": y}}
+
+
+def rocket_scenario():
+    """Ada paces up and down while four people in turn launch a rocket at her.
+
+    Four hits leave enough debris for the garbage crew to go out."""
+    note = {"id": 2000, "type": "Note", "note_text": "Ada Lovelace", "pos": {"x": 27, "y": 61}}
+    instigators = ["Bob", "Carol", "Dan", "Erin"]
+    for step in range(400):
+        yield step * 0.5, avatar(1000, "Ada Lovelace", 10 + abs(step % 80 - 40), 40)
+        if step % 100 == 10:
+            yield step * 0.5, {**note, "updated_by": {"name": instigators[step // 100]}}
+
+
+def quantum_scenario():
+    """Adam starts the sequence, then Grace steps on the target and off again."""
+    yield 0, avatar(1001, "Adam Kelly", 150, 3)
+    yield 1, avatar(1001, "Adam Kelly", 158, 3)
+    yield 2, avatar(1001, "Adam Kelly", 157, 3)
+    for step, x in enumerate(range(164, 159, -1)):
+        yield 5 + step, avatar(1002, "Grace Hopper", x, 3)
+    yield 20, avatar(1002, "Grace Hopper", 160, 4)
+
+
+SCENARIOS = {"rocket": rocket_scenario, "quantum": quantum_scenario}
+
+
+async def run_scenario(name, settle_time=SETTLE_TIME, seed=0):
+    random.seed(seed)
+    echoes = asyncio.Queue()
+    api = InMemoryApi(echo=echoes.put_nowait)
+    # A limiter of our own, so that nothing carries over from an earlier run.
+    handle_entity, app_stats = await APPS[name](api, RateLimiter())
+
+    async def pump_echoes():
+        while True:
+            await handle_entity(await echoes.get())
+
+    pump = asyncio.create_task(pump_echoes())
+    start = time.perf_counter()
+    clock_start = now()
+    for t, entity in SCENARIOS[name]():
+        await asyncio.sleep(max(clock_start + t - now(), 0))
+        await handle_entity(entity)
+    await asyncio.sleep(settle_time)
+    pump.cancel()
+
+    stats = {
+        "elapsed": time.perf_counter() - start,
+        "clock_elapsed": now() - clock_start,
+        "api_calls": api.stats,
+        "bots": sorted((bot["name"], bot["emoji"]) for bot in api.bots.values()),
+    }
+    if app_stats:
+        stats["app"] = app_stats()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a scripted scenario offline.")
+    parser.add_argument("scenario", choices=SCENARIOS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--settle", type=float, default=SETTLE_TIME)
+    parser.add_argument("--real-time", action="store_true", help="use the normal event loop")
+    args = parser.parse_args()
+
+    scenario = run_scenario(args.scenario, args.settle, args.seed)
+    stats = asyncio.run(scenario) if args.real_time else virtualtime.run(scenario)
+    print(json.dumps(stats, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
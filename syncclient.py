@@ -0,0 +1,91 @@
+"""A blocking RC Together client for scripts and threads that don't use asyncio.
+
+    with SyncClient() as client:
+        for bot in client.get_bots():
+            client.update_bot(bot["id"], {"emoji": "🎃"})
+
+Every call is run on one background event loop, so all threads share the same
+keep-alive connection pool and the process-wide rate limiter. A SyncClient can
+be shared between any number of threads:
+
+    with SyncClient() as client, ThreadPoolExecutor(20) as executor:
+        list(executor.map(client.delete_bot, bot_ids))
+
+Bulk operations from bulk.py run on the loop too:
+
+    result = client.bulk(bulk.delete_all)
+
+Don't use it from inside a running event loop; use arctogether.Client there.
+"""
+
+import asyncio
+import threading
+
+import arctogether
+from ratelimit import limiter
+
+
+class SyncClient:
+    def __init__(self, client=None, limiter=limiter):
+        self.client = client if client is not None else arctogether.Client()
+        self.limiter = limiter
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="rc-sync-client", daemon=True
+        )
+        self.thread.start()
+
+    def run(self, coroutine):
+        """Run coroutine on the background loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def request(self, call, endpoint):
+        return self.run(self.limiter.request(call, endpoint=endpoint))
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def get_bots(self):
+        return self.request(self.client.get_bots, "GET /api/bots")
+
+    def create_bot(self, name, emoji, x=5, y=2, direction="right", can_be_mentioned=False):
+        return self.request(
+            lambda: self.client.create_bot(
+                name=name,
+                emoji=emoji,
+                x=x,
+                y=y,
+                direction=direction,
+                can_be_mentioned=can_be_mentioned,
+            ),
+            "POST /api/bots",
+        )
+
+    def update_bot(self, bot_id, bot_attributes):
+        return self.request(
+            lambda: self.client.update_bot(bot_id, bot_attributes), "PATCH /api/bots/{bot_id}"
+        )
+
+    def delete_bot(self, bot_id):
+        return self.request(lambda: self.client.delete_bot(bot_id), "DELETE /api/bots/{bot_id}")
+
+    def send_message(self, bot_id, message_text):
+        return self.request(
+            lambda: self.client.send_message(bot_id, message_text), "POST /api/messages"
+        )
+
+    def bulk(self, operation, *args, **options):
+        """Run a bulk.py operation, e.g. client.bulk(bulk.update_bots, updates)."""
+        options.setdefault("limiter", self.limiter)
+        return self.run(operation(self.client, *args, **options))
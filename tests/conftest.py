@@ -0,0 +1,5 @@
+import os
+
+# arctogether reads these at import time. The tests never talk to RC.
+os.environ.setdefault("RC_APP_ID", "test")
+os.environ.setdefault("RC_APP_SECRET", "test")
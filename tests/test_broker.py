@@ -0,0 +1,34 @@
+import os
+import asyncio
+import tempfile
+
+import pytest
+
+from broker import Broker, BrokerConnection
+from fakeserver import InMemoryApi
+from ratelimit import RateLimiter
+
+
+def test_requests_fail_once_the_broker_hangs_up():
+    async def scenario():
+        path = os.path.join(tempfile.mkdtemp(), "broker.sock")
+        api = InMemoryApi()
+        broker = Broker(api, limiter=RateLimiter())
+        server = await broker.serve(path)
+        connection = BrokerConnection(path)
+        await connection.connect()
+        connection.subscribe(everything=True)
+        bot = await connection.create_bot("Test", "🤖")
+
+        async def no_entities():
+            return
+            yield
+
+        await broker.run(no_entities())
+        assert [entity async for entity in connection] == []
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(connection.delete_bot(bot["id"]), 1)
+        await connection.close()
+        server.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,34 @@
+import asyncio
+
+import virtualtime
+from ratelimit import CircuitBreaker, now
+
+
+def test_only_the_trial_request_closes_or_reopens_the_breaker():
+    async def scenario():
+        breaker = CircuitBreaker("GET /api/bots", threshold=2, reset_time=5)
+        assert not await breaker.wait()
+        assert not await breaker.wait()
+        breaker.record(False)
+        breaker.record(False)
+        assert breaker.opened == 1
+
+        await asyncio.sleep(5)
+        assert await breaker.wait()
+        # Sent before the breaker opened, and only finishing now.
+        breaker.record(True)
+        breaker.record(False)
+        assert breaker.open_until is not None
+        assert breaker.opened == 1
+
+        breaker.record(False, probe=True)
+        assert breaker.opened == 2
+        assert breaker.open_until == now() + 10
+
+        await asyncio.sleep(10)
+        assert await breaker.wait()
+        breaker.record(True, probe=True)
+        assert breaker.open_until is None
+        assert not await breaker.wait()
+
+    virtualtime.run(scenario())
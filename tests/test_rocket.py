@@ -0,0 +1,120 @@
+import asyncio
+
+import arctogether
+import rocket
+import virtualtime
+from bot import Bot, Runtime
+from fakeserver import InMemoryApi
+from ratelimit import RateLimiter
+
+
+class FlakyDeletes(InMemoryApi):
+    def __init__(self, failing_id, failures):
+        super().__init__()
+        self.failing_id = failing_id
+        self.failures = failures
+
+    async def delete_bot(self, bot_id):
+        if bot_id == self.failing_id and self.failures:
+            self.failures -= 1
+            raise arctogether.HttpError(503, "Service unavailable")
+        return await super().delete_bot(bot_id)
+
+
+def test_garbage_that_fails_to_delete_waits_for_the_next_trip():
+    async def scenario():
+        api = FlakyDeletes(failing_id=3, failures=6)
+        runtime = Runtime(api, limiter=RateLimiter())
+        gc_bot = await rocket.GarbageCollectionBot.create(runtime, dwell_time=1)
+
+        def echo(bot_json):
+            if bot_json["id"] == gc_bot.id:
+                asyncio.get_running_loop().create_task(gc_bot.handle_update(bot_json))
+
+        api.echo = echo
+        wrecks = [await Bot.create(runtime, "Wreck", "💥", 30 + i, 60) for i in range(5)]
+        for wreck in wrecks[:4]:
+            await gc_bot.add_garbage(wreck)
+        await asyncio.sleep(300)
+
+        assert not gc_bot.task.done()
+        assert [garbage.id for garbage in gc_bot.garbage] == [3]
+        assert sorted(api.bots) == [1, 3, 6]
+
+        await gc_bot.add_garbage(wrecks[4])
+        gc_bot.enough_garbage.set()
+        await asyncio.sleep(300)
+
+        assert gc_bot.garbage == []
+        assert sorted(api.bots) == [gc_bot.id]
+        gc_bot.task.cancel()
+        await runtime.close()
+
+    virtualtime.run(scenario())
+
+
+def person(entity_id, name, x, y):
+    return {"id": entity_id, "type": "Avatar", "person_name": name, "pos": {"x": x, "y": y}}
+
+
+def note(text):
+    return {
+        "id": 2000,
+        "type": "Note",
+        "note_text": text,
+        "pos": rocket.CONTROL_COMPUTER,
+        "updated_by": {"name": "Bob"},
+    }
+
+
+def test_clearing_the_note_keeps_the_pool_to_its_size():
+    async def scenario():
+        api = InMemoryApi()
+        runtime = Runtime(api, limiter=RateLimiter())
+        launch_system = await rocket.ClankyBotLaunchSystem.create(runtime, pool_size=3)
+        await launch_system.handle_entity(person(1000, "Ada Lovelace", 40, 40))
+        await launch_system.handle_entity(note("Ada Lovelace"))
+        await asyncio.sleep(1)
+        assert len(launch_system.launches) == 1
+        assert len(launch_system.pool) == 3
+
+        await launch_system.handle_entity(note(""))
+        await asyncio.sleep(1)
+        assert launch_system.launches == {}
+        assert len(launch_system.pool) == 3
+        assert len(api.bots) == 4
+        await runtime.close()
+
+    virtualtime.run(scenario())
+
+
+def test_a_target_who_never_turns_up_gives_back_the_rocket():
+    async def scenario():
+        api = InMemoryApi()
+        runtime = Runtime(api, limiter=RateLimiter())
+        launch_system = await rocket.ClankyBotLaunchSystem.create(runtime, pool_size=3)
+        await launch_system.handle_entity(note("Ada Lovelase"))
+        await asyncio.sleep(1)
+        assert len(launch_system.launches) == 1
+
+        await asyncio.sleep(rocket.TARGET_TIMEOUT)
+        assert launch_system.launches == {}
+        assert len(launch_system.pool) == 3
+        assert len(api.bots) == 4
+        await runtime.close()
+
+    virtualtime.run(scenario())
+
+
+def test_intercept_stays_on_the_grid():
+    aim = rocket.predict_intercept([(0, 5, 10), (1, 2, 10)], rocket.xy(rocket.LAUNCH_PAD))
+    assert aim == {"x": 0, "y": 10}
+
+
+def test_a_target_that_jumps_is_tracked_afresh():
+    launch = rocket.Launch(None, "Ada Lovelace", "Bob", 0)
+    launch.sighted({"x": 40, "y": 40}, 0)
+    launch.sighted({"x": 41, "y": 40}, 0.5)
+    launch.sighted({"x": 120, "y": 5}, 1)
+    assert list(launch.history) == [(1, 120, 5)]
+    assert rocket.predict_intercept(launch.history, (25, 60)) == {"x": 120, "y": 5}
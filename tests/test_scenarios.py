@@ -0,0 +1,42 @@
+import scenarios
+import virtualtime
+
+
+def run(name, seed=0):
+    return virtualtime.run(scenarios.run_scenario(name, seed=seed))
+
+
+def without_timings(stats):
+    return {key: value for key, value in stats.items() if key != "elapsed"}
+
+
+def test_rocket_launches_hit_and_debris_is_collected():
+    stats = run("rocket")
+
+    assert stats["app"]["launches"] == 4
+    assert stats["app"]["hits"] == 4
+    assert stats["app"]["in_flight"] == 0
+    # All four wrecks collected, leaving the garbage truck and a full pool.
+    assert stats["api_calls"]["DELETE /api/bots/{bot_id}"] == 4
+    assert stats["bots"] == [("Garbage Collector", "🛺")] + [("Rocket Bot", "🚀")] * 3
+
+
+def test_quantum_breaks_and_mends_reality():
+    stats = run("quantum")
+
+    assert stats["api_calls"]["POST /api/bots"] == 21
+    assert ("Particle", "🔥") in stats["bots"]
+    broken = [emoji for name, emoji in stats["bots"] if name != "Particle"]
+    assert broken == ["🐞"] * 20
+
+
+def test_scenarios_take_no_real_time():
+    stats = run("rocket")
+
+    assert stats["clock_elapsed"] > 300
+    assert stats["elapsed"] < 5
+
+
+def test_scenarios_repeat_exactly():
+    assert without_timings(run("rocket", seed=1)) == without_timings(run("rocket", seed=1))
+    assert without_timings(run("quantum", seed=1)) == without_timings(run("quantum", seed=1))
@@ -0,0 +1,49 @@
+from updates import Mailbox
+
+
+def bot_json(x, y, emoji="🚀"):
+    return {"id": 1, "emoji": emoji, "pos": {"x": x, "y": y}}
+
+
+def test_an_emoji_change_and_a_move_go_out_together():
+    mailbox = Mailbox()
+    mailbox.put({"emoji": "💥"})
+    mailbox.put({"x": 10, "y": 20})
+    assert mailbox.take(bot_json(1, 1)) == {"emoji": "💥", "x": 10, "y": 20}
+    assert mailbox.empty()
+
+
+def test_fields_that_change_nothing_are_skipped():
+    mailbox = Mailbox()
+    mailbox.put({"emoji": "🚀", "x": 1, "y": 5})
+    assert mailbox.take(bot_json(1, 1)) == {"y": 5}
+
+
+def test_a_move_back_to_the_position_being_left_is_sent():
+    mailbox = Mailbox()
+    mailbox.put({"x": 2})
+    assert mailbox.take(bot_json(1, 1)) == {"x": 2}
+
+    # The server hasn't shown the bot leaving x=1 yet.
+    mailbox.put({"x": 1})
+    assert mailbox.take(bot_json(1, 1)) == {"x": 1}
+
+
+def test_a_failed_update_is_restored_under_newer_fields():
+    mailbox = Mailbox()
+    mailbox.put({"emoji": "💥", "x": 2})
+    failed = mailbox.take(bot_json(1, 1))
+    mailbox.put({"x": 3})
+    mailbox.restore(failed)
+    assert mailbox.take(bot_json(1, 1)) == {"emoji": "💥", "x": 3}
+
+
+def test_a_failed_update_is_no_longer_treated_as_sent():
+    mailbox = Mailbox()
+    mailbox.put({"x": 2})
+    failed = mailbox.take(bot_json(1, 1))
+    mailbox.forget(failed)
+
+    # With nothing in flight, staying put is a no-op again.
+    mailbox.put({"x": 1})
+    assert mailbox.take(bot_json(1, 1)) == {}
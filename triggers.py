@@ -0,0 +1,148 @@
+import time
+
+from metrics import metrics
+from world import CELL_SIZE, normalise_name
+
+UPDATE = "update"
+ENTER = "enter"
+LEAVE = "leave"
+
+
+class Trigger:
+    __slots__ = ("label", "metric_label", "handler", "event", "contains", "hits", "elapsed")
+
+    def __init__(self, label, handler, event=UPDATE, contains=None, metric_label=None):
+        self.label = label
+        # Entity and person triggers come and go with every rocket, so their
+        # timings are pooled under one label rather than one per trigger.
+        self.metric_label = metric_label or label
+        self.handler = handler
+        self.event = event
+        # For tile and region triggers, whether a position is inside.
+        self.contains = contains
+        self.hits = 0
+        self.elapsed = 0
+
+    async def fire(self, entity):
+        self.hits += 1
+        start = time.perf_counter()
+        try:
+            await self.handler(entity)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.elapsed += elapsed
+            metrics.observe("handler", elapsed, handler=self.metric_label)
+
+
+class Triggers:
+    """Routes entity updates to the handlers that declared an interest in them.
+
+    Handlers register for an entity id, a person's name, a tile or a
+    rectangular region. Every update is routed through dict lookups on those
+    keys, so the cost of an update doesn't grow with the number of triggers and
+    every matching handler runs, whatever order they were registered in.
+
+    Tile and region triggers fire on UPDATE (any update while inside), ENTER
+    or LEAVE."""
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.by_id = {}
+        self.by_name = {}
+        self.by_tile = {}
+        self.by_cell = {}
+        self.positions = {}
+        # Stats for triggers that have since been removed, by label.
+        self.retired = {}
+
+    def on_entity(self, entity_id, handler):
+        return add(
+            self.by_id, entity_id, Trigger(f"entity {entity_id}", handler, metric_label="entity")
+        )
+
+    def on_person(self, name, handler):
+        name = normalise_name(name)
+        return add(self.by_name, name, Trigger(f"person {name}", handler, metric_label="person"))
+
+    def on_tile(self, pos, handler, event=UPDATE):
+        tile = (pos["x"], pos["y"])
+        trigger = Trigger(f"tile {tile} {event}", handler, event, tile.__eq__)
+        return add(self.by_tile, tile, trigger)
+
+    def on_region(self, x0, y0, x1, y1, handler, event=ENTER):
+        def contains(position):
+            return x0 <= position[0] <= x1 and y0 <= position[1] <= y1
+
+        trigger = Trigger(f"region {(x0, y0, x1, y1)} {event}", handler, event, contains)
+        for cx in range(x0 // self.cell_size, x1 // self.cell_size + 1):
+            for cy in range(y0 // self.cell_size, y1 // self.cell_size + 1):
+                add(self.by_cell, (cx, cy), trigger)
+        return trigger
+
+    def remove(self, trigger):
+        retired = self.retired.setdefault(trigger.label, {"hits": 0, "elapsed": 0})
+        retired["hits"] += trigger.hits
+        retired["elapsed"] += trigger.elapsed
+        for index in (self.by_id, self.by_name, self.by_tile, self.by_cell):
+            for key, triggers in list(index.items()):
+                if trigger in triggers:
+                    triggers.remove(trigger)
+                    if not triggers:
+                        del index[key]
+
+    def cell(self, position):
+        return (position[0] // self.cell_size, position[1] // self.cell_size)
+
+    def positional(self, position):
+        if position is None:
+            return []
+        return self.by_tile.get(position, []) + self.by_cell.get(self.cell(position), [])
+
+    def matching(self, entity):
+        matched = list(self.by_id.get(entity["id"], ()))
+        name = normalise_name(entity.get("person_name"))
+        if name:
+            matched.extend(self.by_name.get(name, ()))
+
+        pos = entity.get("pos")
+        position = (pos["x"], pos["y"]) if pos else None
+        previous = self.positions.get(entity["id"])
+        self.positions[entity["id"]] = position
+
+        seen = set()
+        for trigger in self.positional(position) + self.positional(previous):
+            if trigger in seen:
+                continue
+            seen.add(trigger)
+            inside = position is not None and trigger.contains(position)
+            was_inside = previous is not None and trigger.contains(previous)
+            if trigger.event == UPDATE and inside:
+                matched.append(trigger)
+            elif trigger.event == ENTER and inside and not was_inside:
+                matched.append(trigger)
+            elif trigger.event == LEAVE and was_inside and not inside:
+                matched.append(trigger)
+        return matched
+
+    async def dispatch(self, entity):
+        for trigger in self.matching(entity):
+            await trigger.fire(entity)
+
+    def stats(self):
+        triggers = dict.fromkeys(
+            trigger
+            for index in (self.by_id, self.by_name, self.by_tile, self.by_cell)
+            for triggers in index.values()
+            for trigger in triggers
+        )
+        stats = {label: dict(counts) for label, counts in self.retired.items()}
+        for trigger in triggers:
+            counts = stats.setdefault(trigger.label, {"hits": 0, "elapsed": 0})
+            counts["hits"] += trigger.hits
+            counts["elapsed"] += trigger.elapsed
+        return stats
+
+
+def add(index, key, trigger):
+    index.setdefault(key, []).append(trigger)
+    return trigger
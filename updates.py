@@ -0,0 +1,62 @@
+import time
+
+
+def current_value(bot_json, key):
+    # Bots report their position as {"pos": {"x": .., "y": ..}} but are moved
+    # with top level "x" and "y" fields.
+    if key in ("x", "y"):
+        return bot_json.get("pos", {}).get(key)
+    return bot_json.get(key)
+
+
+class Mailbox:
+    """The latest pending state for one bot.
+
+    Partial updates are merged field by field, so an emoji change followed by a
+    move is sent as a single PATCH rather than the move replacing the emoji. The
+    mailbox never holds more than one value per field however many updates
+    arrive while a PATCH is in flight."""
+
+    __slots__ = ("pending", "sent", "since")
+
+    def __init__(self):
+        self.pending = {}
+        self.sent = {}
+        # When the oldest pending update arrived.
+        self.since = None
+
+    def put(self, update):
+        if not self.pending:
+            self.since = time.perf_counter()
+        self.pending.update(update)
+
+    def empty(self):
+        return not self.pending
+
+    def take(self, bot_json):
+        """Remove and return the pending fields that would change the bot.
+
+        A field is only dropped if it matches both what the server last told us
+        (bot_json) and the last value we sent, so we never skip a move back to a
+        position the bot is currently leaving."""
+        update = {
+            key: value
+            for key, value in self.pending.items()
+            if current_value(bot_json, key) != value or self.sent.get(key, value) != value
+        }
+        self.pending = {}
+        self.sent.update(update)
+        return update
+
+    def restore(self, update):
+        """Put back the fields of a failed update that haven't been replaced since."""
+        self.forget(update)
+        if not self.pending:
+            self.since = time.perf_counter()
+        self.pending = {**update, **self.pending}
+
+    def forget(self, update):
+        """Stop treating the fields of a failed update as sent."""
+        for key, value in update.items():
+            if self.sent.get(key) == value:
+                del self.sent[key]
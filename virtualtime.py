@@ -0,0 +1,51 @@
+"""An event loop on a virtual clock, for running bot logic without the waiting.
+
+Everything the bots wait on or time goes through the event loop: asyncio.sleep,
+wait_for timeouts, ratelimit.now(). VirtualTimeLoop keeps its own clock and,
+whenever nothing is ready to run, jumps it straight to the next timer rather
+than sleeping. Rocket dwell times, rate limits, retry backoff and quantum's
+random pauses all take no real time, and given the same inputs and random
+seed a run does the same thing every time.
+
+    virtualtime.run(main())
+
+This is only useful with in-process backends such as fakeserver.InMemoryApi.
+Real sockets still work, but the clock doesn't wait for them: it only stands
+still while the loop has no timers at all.
+"""
+
+import asyncio
+import selectors
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """Polls for I/O without blocking, and moves the clock instead of waiting."""
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # No timers, so nothing will happen until some real I/O does.
+            return super().select(None)
+        self.clock.virtual_time += timeout
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self, start=0.0):
+        self.virtual_time = start
+        super().__init__(VirtualSelector(self))
+
+    def time(self):
+        return self.virtual_time
+
+
+def run(main, start=0.0):
+    """Like asyncio.run, but on a VirtualTimeLoop."""
+    with asyncio.Runner(loop_factory=lambda: VirtualTimeLoop(start)) as runner:
+        return runner.run(main)
@@ -0,0 +1,113 @@
+import math
+import time
+
+from decode import Entity
+
+# Width and height, in tiles, of each bucket in the spatial hash.
+CELL_SIZE = 8
+
+
+def normalise_name(name):
+    if name is None:
+        return None
+    return name.strip("\n\r\t \u200b")
+
+
+class World:
+    """Every entity we've seen, indexed by id, by person name and by position.
+
+    Looking up who is standing on a tile is a single dict lookup, and area
+    queries only visit the spatial hash cells that overlap the area, so apps
+    don't need to keep their own dicts of positions."""
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.entities = {}
+        self.by_name = {}
+        self.by_position = {}
+        self.cells = {}
+        # Wall clock time each entity was last seen, and the ids that changed
+        # since the last save, for WorldStore.
+        self.seen = {}
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, entity_id):
+        return entity_id in self.entities
+
+    def get(self, entity_id):
+        return self.entities.get(entity_id)
+
+    def cell(self, x, y):
+        return (x // self.cell_size, y // self.cell_size)
+
+    def update(self, entity, seen=None):
+        if not isinstance(entity, Entity):
+            entity = Entity(entity)
+        self.remove(entity.id)
+
+        self.entities[entity.id] = entity
+        self.seen[entity.id] = time.time() if seen is None else seen
+        self.dirty.add(entity.id)
+        name = normalise_name(entity.person_name)
+        if name:
+            self.by_name[name] = entity
+        if entity.x is not None:
+            self.by_position.setdefault((entity.x, entity.y), set()).add(entity.id)
+            self.cells.setdefault(self.cell(entity.x, entity.y), set()).add(entity.id)
+        return entity
+
+    def remove(self, entity_id):
+        entity = self.entities.pop(entity_id, None)
+        if entity is None:
+            return
+        del self.seen[entity_id]
+        self.dirty.add(entity_id)
+
+        name = normalise_name(entity.person_name)
+        if name and self.by_name.get(name) is entity:
+            del self.by_name[name]
+        if entity.x is not None:
+            discard(self.by_position, (entity.x, entity.y), entity_id)
+            discard(self.cells, self.cell(entity.x, entity.y), entity_id)
+
+    def person(self, name):
+        return self.by_name.get(normalise_name(name))
+
+    def position_of(self, name):
+        person = self.person(name)
+        return person.pos if person else None
+
+    def at(self, x, y):
+        return [self.entities[entity_id] for entity_id in self.by_position.get((x, y), ())]
+
+    def in_rect(self, x0, y0, x1, y1):
+        """Entities with x0 <= x <= x1 and y0 <= y <= y1."""
+        cx0, cy0 = self.cell(x0, y0)
+        cx1, cy1 = self.cell(x1, y1)
+        found = []
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                for entity_id in self.cells.get((cx, cy), ()):
+                    entity = self.entities[entity_id]
+                    if x0 <= entity.x <= x1 and y0 <= entity.y <= y1:
+                        found.append(entity)
+        return found
+
+    def within(self, x, y, radius):
+        r = math.floor(radius)
+        return [
+            entity
+            for entity in self.in_rect(x - r, y - r, x + r, y + r)
+            if math.hypot(entity.x - x, entity.y - y) <= radius
+        ]
+
+
+def discard(index, key, entity_id):
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(entity_id)
+        if not ids:
+            del index[key]
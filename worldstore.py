@@ -0,0 +1,71 @@
+"""Keep the world in a local SQLite file so a restarted bot knows where everyone is.
+
+Set RC_WORLD_CACHE to the file to use:
+
+    RC_WORLD_CACHE=world.sqlite3 python rocket.py
+"""
+
+import os
+import json
+import time
+import sqlite3
+import asyncio
+
+# Seconds between writing changed entities to disk.
+SAVE_INTERVAL = 10
+
+# Forget entities that haven't been seen for this many seconds. Nobody wants a
+# rocket sent to where someone was standing last week.
+MAX_AGE = 6 * 60 * 60
+
+
+class WorldStore:
+    def __init__(self, path, max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entities (id INTEGER PRIMARY KEY, seen REAL, data TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS entities_seen ON entities (seen)")
+
+    def load(self, world):
+        """Fill world with everything seen recently enough."""
+        rows = self.db.execute(
+            "SELECT seen, data FROM entities WHERE seen > ?", (time.time() - self.max_age,)
+        )
+        for seen, data in rows:
+            world.update(json.loads(data), seen)
+        world.dirty.clear()
+        print(f"Loaded {len(world)} entities from {self.path}")
+
+    def save(self, world):
+        """Write out entities changed since the last save, and drop expired ones."""
+        dirty, world.dirty = world.dirty, set()
+        rows = [
+            (entity_id, world.seen[entity_id], json.dumps(world.entities[entity_id].asdict()))
+            for entity_id in dirty
+            if entity_id in world.entities
+        ]
+        gone = [(entity_id,) for entity_id in dirty if entity_id not in world.entities]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?)", rows)
+            self.db.executemany("DELETE FROM entities WHERE id = ?", gone)
+            self.db.execute("DELETE FROM entities WHERE seen <= ?", (time.time() - self.max_age,))
+
+    async def run(self, world, interval=SAVE_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.save(world)
+
+    def close(self, world):
+        self.save(world)
+        self.db.execute("VACUUM")
+        self.db.close()
+
+
+def store_from_env():
+    path = os.environ.get("RC_WORLD_CACHE")
+    if path:
+        return WorldStore(path)
+    return None